@@ -0,0 +1,355 @@
+"""Offline benchmark for bot.py: fake Docker nodes with configurable latencies and a fake Discord side.
+
+Runs without a token or a Docker daemon. Every run works in a fresh temp directory (bot.py keeps
+its data in ./data), seeds 10k users and VPSes, and reports throughput and latency percentiles
+per scenario. Save the numbers with --json to compare them across commits.
+
+    python bench.py
+    python bench.py --latency-scale 0.1 --only deploy,lookup --json bench.json
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds per call before --latency-scale
+LATENCIES = {
+    "run_container": 0.3,
+    "exec": 0.02,
+    "stop": 0.05,
+    "start": 0.05,
+    "restart": 0.1,
+    "remove": 0.05,
+    "update": 0.02,
+    "rename": 0.02,
+    "inspect": 0.01,
+    "list_containers": 0.05,
+    "fetch_user": 0.05,
+    "dm": 0.1,
+    "edit_response": 0.05,
+    "guild_invites": 0.1,
+}
+
+SCENARIOS = ("deploy", "lookup", "send_log", "unique_join", "giveaway_burst", "join_raid", "mass_expiry")
+
+def load_bot():
+    """Import bot.py from a temp working directory so its data files never touch the repo"""
+    os.chdir(tempfile.mkdtemp(prefix="bot-bench-"))
+    spec = importlib.util.spec_from_file_location("bot", os.path.join(HERE, "bot.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["bot"] = module
+    spec.loader.exec_module(module)
+    return module
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))] if ordered else 0.0
+
+def summarize(name, latencies, elapsed, ops=None):
+    ops = len(latencies) if ops is None else ops
+    return {
+        "scenario": name,
+        "ops": ops,
+        "seconds": round(elapsed, 4),
+        "ops_per_sec": round(ops / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+class Bench:
+    def __init__(self, bot, args):
+        self.bot = bot
+        self.args = args
+        self.latency = {op: seconds * args.latency_scale for op, seconds in LATENCIES.items()}
+
+    # ---- fakes ----
+    def make_backend(self):
+        """FakeDockerBackend whose calls take the configured time"""
+        backend = self.bot.FakeDockerBackend(ncpu=100000, mem_gb=10 ** 7)
+        for op in ("run_container", "exec", "stop", "start", "restart", "remove", "update", "rename", "inspect", "list_containers"):
+            setattr(backend, op, self.slowed(getattr(backend, op), op))
+        return backend
+
+    def slowed(self, fn, op):
+        async def call(*args, **kwargs):
+            await asyncio.sleep(self.latency[op])
+            return await fn(*args, **kwargs)
+        return call
+
+    def fake_user(self, uid):
+        bench = self
+
+        class User:
+            id = int(uid)
+            name = f"user{uid}"
+            mention = f"<@{uid}>"
+
+            async def send(self, *args, **kwargs):
+                await asyncio.sleep(bench.latency["dm"])
+
+        return User()
+
+    async def fetch_user(self, uid):
+        await asyncio.sleep(self.latency["fetch_user"])
+        return self.fake_user(uid)
+
+    def interaction(self):
+        bench = self
+
+        class Response:
+            done = False
+
+            def is_done(self):
+                return self.done
+
+            async def defer(self, **kwargs):
+                self.done = True
+
+        class Interaction:
+            created_at = self.bot.discord.utils.utcnow()
+            response = Response()
+
+            async def edit_original_response(self, **kwargs):
+                await asyncio.sleep(bench.latency["edit_response"])
+
+        return Interaction()
+
+    # ---- setup ----
+    async def setup(self):
+        bot = self.bot
+        bot.bot.fetch_user = self.fetch_user
+        bot.WARM_POOL_SIZE = self.args.warm_pool
+        bot.INVITE_DIFF_DELAY = 0.25
+        bot.METRICS_PORT = 0
+        bot.nodes.clear()
+        for i in range(self.args.nodes):
+            node = bot.DockerNode(f"node{i}", f"fake://node{i}", f"10.0.0.{i + 1}")
+            node.backend = self.make_backend()
+            bot.nodes[node.name] = node
+        bot.DEFAULT_NODE = "node0"
+        self.seed(self.args.users, self.args.vps)
+        await bot.prepare_docker_host()
+        while bot.warm_pool_task and not bot.warm_pool_task.done():
+            await asyncio.sleep(0.05)
+        bot.start_deadline_scheduler()
+        self.log_task = asyncio.create_task(bot.log_consumer())
+
+    def seed(self, n_users, n_vps):
+        """n_users users with a few unique joins each and n_vps VPSes spread over the nodes"""
+        bot = self.bot
+        rng = random.Random(42)
+        node_names = list(bot.nodes)
+        for uid in range(1, n_users + 1):
+            bot.users[str(uid)] = {
+                "points": rng.randint(0, 50), "inv_unclaimed": 0, "inv_total": 0, "invites": [],
+                "unique_joins": [str(10 ** 9 + rng.randint(0, n_users * 10)) for _ in range(rng.randint(0, 5))],
+            }
+        now = datetime.utcnow()
+        for i in range(n_vps):
+            node = bot.nodes[node_names[i % len(node_names)]]
+            cid = f"seed{i:08x}"
+            node.backend.containers[cid] = {"name": f"seed-{i}", "image": "x", "state": "running", "ram": 1, "cpu": 1, "disk": 10, "ports": {}}
+            bot.vps_db[cid] = {
+                "owner": str(rng.randint(1, n_users)), "container_id": cid, "name": f"seed-{i}", "node": node.name,
+                "ram": 1, "cpu": 1, "disk": 10, "http_port": None, "ssh": "ssh seeded@tmate.io",
+                "created_at": now.isoformat(), "expires_at": (now + timedelta(days=rng.randint(1, 15))).isoformat(),
+                "active": True, "suspended": False, "paid_plan": False, "giveaway_vps": False,
+                "shared_with": [], "additional_ports": [], "systemctl_working": True,
+            }
+        bot.persist_users()
+        bot.persist_vps()
+        bot.invite_tracker = bot.InviteTracker(bot.users)
+
+    # ---- scenarios ----
+    async def run_deploy(self):
+        """Deploys through the interaction job path, DEPLOY_CONCURRENCY at a time"""
+        bot = self.bot
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        latencies, acks = [], []
+
+        async def deploy(i):
+            async with semaphore:
+                start = time.perf_counter()
+                interaction = self.interaction()
+
+                async def work(job):
+                    return await bot.create_vps(900000 + i, 1, 1, 10, admission_timeout=None, progress=job.stage)
+
+                job = await bot.run_interaction_job(interaction, ("deploy", i), "Deploying VPS", work)
+                acks.append(time.perf_counter() - start)
+                await job.task
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(deploy(i) for i in range(self.args.deploys)))
+        result = summarize("deploy", latencies, time.perf_counter() - start)
+        result["ack_p99_ms"] = round(percentile(acks, 99) * 1000, 3)
+        return result
+
+    async def run_lookup(self):
+        bot = self.bot
+        rng = random.Random(1)
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(self.args.lookups):
+            t = time.perf_counter()
+            bot.get_user_vps(rng.randint(1, self.args.users))
+            latencies.append(time.perf_counter() - t)
+        return summarize("lookup", latencies, time.perf_counter() - start)
+
+    async def run_send_log(self):
+        """Enqueue latency per entry; elapsed runs until the JSONL sink has drained the queue"""
+        bot = self.bot
+        user = self.fake_user(1)
+        latencies = []
+        start = time.perf_counter()
+        for i in range(self.args.logs):
+            t = time.perf_counter()
+            await bot.send_log("Bench", user, f"entry {i}", f"vps{i}")
+            latencies.append(time.perf_counter() - t)
+        while not bot.log_queue.empty():
+            await asyncio.sleep(0.01)
+        return summarize("send_log", latencies, time.perf_counter() - start)
+
+    async def run_unique_join(self):
+        bot = self.bot
+        rng = random.Random(2)
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(self.args.joins):
+            t = time.perf_counter()
+            bot.add_unique_join(rng.randint(10 ** 10, 2 * 10 ** 10), rng.randint(1, self.args.users))
+            latencies.append(time.perf_counter() - t)
+        bot.invite_tracker.flush()
+        return summarize("unique_join", latencies, time.perf_counter() - start)
+
+    async def run_giveaway_burst(self):
+        """A giveaway for everyone ends: one deploy and DM per participant"""
+        bot = self.bot
+        latencies = []
+        create_vps = bot.create_vps
+
+        async def timed_create(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return await create_vps(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - t)
+
+        bot.create_vps = timed_create
+        gid = "bench-giveaway"
+        bot.giveaways[gid] = {
+            "status": "active", "winner_type": "all", "end_time": datetime.utcnow().isoformat(),
+            "participants": [str(800000 + i) for i in range(self.args.giveaway)],
+            "vps_ram": 1, "vps_cpu": 1, "vps_disk": 10,
+        }
+        start = time.perf_counter()
+        try:
+            await bot.end_giveaway(gid)
+            await bot.provision_tasks[gid]
+        finally:
+            bot.create_vps = create_vps
+        result = summarize("giveaway_burst", latencies, time.perf_counter() - start)
+        result["succeeded"] = bot.get_provisioning_progress(gid)["succeeded"]
+        return result
+
+    async def run_join_raid(self):
+        """Members join in a burst through on_member_join; elapsed runs until every join is credited"""
+        bot = self.bot
+        bench = self
+        invites = {"raid": {"uses": 0, "inviter": 424242}}
+
+        class Invite:
+            def __init__(self, code, entry):
+                self.code, self.uses, self.max_uses = code, entry["uses"], 0
+                self.inviter = bench.fake_user(entry["inviter"])
+
+        class Guild:
+            id = 777
+
+            async def invites(self):
+                await asyncio.sleep(bench.latency["guild_invites"])
+                return [Invite(code, entry) for code, entry in invites.items()]
+
+        guild = Guild()
+        bot.invite_snapshot[str(guild.id)] = await bot.fetch_guild_invites(guild)
+        before = len(bot.invite_tracker.joins.get(424242, ()))
+        latencies = []
+        start = time.perf_counter()
+        for i in range(self.args.raid):
+            member = self.fake_user(5 * 10 ** 10 + i)
+            member.bot = False
+            member.guild = guild
+            invites["raid"]["uses"] += 1
+            t = time.perf_counter()
+            await bot.on_member_join(member)
+            latencies.append(time.perf_counter() - t)
+            await asyncio.sleep(0)
+        while len(bot.invite_tracker.joins.get(424242, ())) - before < self.args.raid and time.perf_counter() - start < 60:
+            await asyncio.sleep(0.01)
+        result = summarize("join_raid", latencies, time.perf_counter() - start)
+        result["credited"] = len(bot.invite_tracker.joins.get(424242, ())) - before
+        return result
+
+    async def run_mass_expiry(self):
+        """EXPIRY VPSes come due at once; elapsed runs until the scheduler has suspended all of them"""
+        bot = self.bot
+        cids = [cid for cid, rec in bot.vps_db.items() if cid.startswith("seed") and not rec.get("suspended")][:self.args.expiry]
+        past = (datetime.utcnow() - timedelta(seconds=1)).isoformat()
+        start = time.perf_counter()
+        for cid in cids:
+            bot.vps_db[cid]["expires_at"] = past
+        bot.persist_vps(*cids)
+        while sum(bot.vps_db[cid]["suspended"] for cid in cids) < len(cids) and time.perf_counter() - start < 120:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        # Per-VPS latency isn't observable from outside the batch; report the batch time for each
+        return summarize("mass_expiry", [elapsed] * len(cids), elapsed)
+
+async def main(args):
+    bot = load_bot()
+    bench = Bench(bot, args)
+    setup_start = time.perf_counter()
+    await bench.setup()
+    results = []
+    for name in args.only.split(",") if args.only else SCENARIOS:
+        results.append(await getattr(bench, f"run_{name}")())
+        print(json.dumps(results[-1]))
+    report = {
+        "commit": subprocess.run(["git", "-C", HERE, "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip(),
+        "setup_seconds": round(time.perf_counter() - setup_start, 3),
+        "args": vars(args),
+        "results": results,
+    }
+    if args.json:
+        with open(os.path.join(HERE, args.json) if not os.path.isabs(args.json) else args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplier for every fake call latency")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--vps", type=int, default=10000)
+    parser.add_argument("--warm-pool", type=int, default=0, help="WARM_POOL_SIZE per node")
+    parser.add_argument("--deploys", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="deploys in flight at once")
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--logs", type=int, default=10000)
+    parser.add_argument("--joins", type=int, default=10000)
+    parser.add_argument("--giveaway", type=int, default=200, help="giveaway participants")
+    parser.add_argument("--raid", type=int, default=500, help="members in the join raid")
+    parser.add_argument("--expiry", type=int, default=1000, help="VPSes expiring at once")
+    parser.add_argument("--only", help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--json", help="write the report to this file")
+    asyncio.run(main(parser.parse_args()))
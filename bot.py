@@ -1,22 +1,79 @@
 # Final Complete bot.py with all commands, manage buttons, SSH, share, renew, suspend, points, invites, giveaways
 import discord
 from discord import app_commands
-from discord.ext import commands, tasks
+from discord.ext import commands
 import asyncio
 import subprocess
 import json
 import os
 import random
+import re
+import io
+import tarfile
+import hashlib
+import heapq
+import contextlib
+import functools
+import shutil
 import logging
+import sqlite3
+import sys
+import time
+from collections import deque
 from datetime import datetime, timedelta
 
+try:
+    import aiohttp  # Ships with discord.py; only needed for the engine API backend
+except ImportError:
+    aiohttp = None
+
+STARTED_AT = time.perf_counter()
+
 # ---------------- CONFIG ----------------
 TOKEN = ""
 GUILD_ID = 1432390408184529084
 MAIN_ADMIN_IDS = {1397506807089598474}  # CHANGED: Renamed to MAIN_ADMIN_IDS
 SERVER_IP = "207.244.240.48"
 QR_IMAGE = ""
-IMAGE = "jrei/systemd-ubuntu:22.04"
+IMAGE = "jrei/systemd-ubuntu:22.04"  # Fallback image when the baked image isn't built yet
+VPS_IMAGE_NAME = "ubuntu-22.04-with-tmate"
+DOCKERFILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "DockerFile")
+READY_TIMEOUT = 90  # Max seconds to wait for systemd inside a new container
+TMATE_READY_TIMEOUT = 30  # Max seconds to wait for a new tmate session to get its SSH address
+SSH_REFRESH_INTERVAL = 600  # Seconds between background checks that revive dead tmate sessions
+SSH_REFRESH_CONCURRENCY = 8  # Containers checked at once by the background refresh
+WARM_POOL_SIZE = 2  # Idle pre-booted containers kept ready for instant deploys (0 disables)
+DOCKER_BACKEND = "auto"  # "engine" (Docker API), "cli" (docker binary) or "auto" (engine if the socket exists)
+DOCKER_SOCKET = "/var/run/docker.sock"
+DOCKER_API_POOL_SIZE = 20  # Max keep-alive connections to the Docker API (per node)
+# Docker hosts VPSes are placed on. endpoint: unix:///path, tcp://host:port or fake://<name> (in-memory, for tests)
+NODES = {
+    "local": {"endpoint": f"unix://{DOCKER_SOCKET}", "public_ip": SERVER_IP},
+}
+NODE_HEALTH_INTERVAL = 30  # Seconds between node health checks
+SHARD_COUNT = None  # Gateway shards (None uses Discord's recommended count)
+JOB_WORKERS = 0  # Worker processes that run Docker calls off the bot's event loop (0 runs them in-process)
+WORKER_CONCURRENCY = 16  # Docker calls each worker runs at once
+JOB_POLL_INTERVAL = 0.05  # Seconds between job queue polls (bot and workers)
+JOB_LEASE_SECONDS = 900  # Jobs not finished within this are failed (worker died or none running)
+PROVISION_CONCURRENCY = 4  # Max giveaway VPS deploys running at once
+CPU_OVERCOMMIT = 4.0  # Allocated vCPUs allowed per host CPU
+RAM_OVERCOMMIT = 1.5  # Allocated RAM allowed per GB of host RAM
+DISK_OVERCOMMIT = 3.0  # Allocated disk allowed per GB of host disk
+MIN_FREE_RAM_GB = 2  # Deploys wait while the host has less free RAM than this, whatever is allocated
+ADMISSION_QUEUE_TIMEOUT = 300  # Seconds a deploy waits for capacity before it is rejected
+HTTP_PORT_RANGE = (3000, 3999)  # Host ports handed out for each VPS's port 80
+FORWARD_PORT_RANGE = (20000, 29999)  # Host ports handed out for additional_ports
+FORWARD_IMAGE = "alpine/socat"  # Sidecar image that relays each additional port to its VPS
+FORWARD_BIND_GRACE = 1  # Seconds a new forward sidecar must stay up to count as bound to its port
+ENFORCE_DISK_QUOTA = True  # Cap container disk with --storage-opt size= when the storage driver supports it
+EXPIRY_CONCURRENCY = 8  # Max VPS expirations / giveaway endings handled at once
+EXPIRY_RETRY_DELAY = 60  # Seconds before retrying an expired VPS whose container didn't stop
+BULK_BATCH_SIZE = 50  # Containers per batched stop/start/remove call in bulk operations
+BULK_CONCURRENCY = 4  # Batched calls of one bulk operation in flight at once
+TELEMETRY_INTERVAL = 10  # Seconds between kept container usage samples
+TELEMETRY_HISTORY = 360  # Samples kept per container (1 hour at 10s)
+DOCKER_DATA_ROOT = "/var/lib/docker"  # Filesystem whose size is reported as host disk
 DEFAULT_RAM_GB = 32
 DEFAULT_CPU = 6
 DEFAULT_DISK_GB = 100
@@ -30,7 +87,29 @@ POINTS_RENEW_15 = 4
 POINTS_RENEW_30 = 8
 VPS_LIFETIME_DAYS = 15
 RENEW_MODE_FILE = os.path.join(DATA_DIR, "renew_mode.json")
+COMMAND_HASH_FILE = os.path.join(DATA_DIR, "command_tree.hash")  # Hash of the last synced command tree
+INVITE_FLUSH_DELAY = 5  # Seconds new unique joins wait so a burst is saved in one write
+INVITE_DIFF_DELAY = 2  # Seconds member joins are collected before one invite fetch attributes them
+INVITE_RETRY_MAX_DELAY = 300  # Cap on the doubling wait between failed invite fetches
+NODE_STATE_FILE = os.path.join(DATA_DIR, "nodes.json")  # Drain flags set at runtime
+WAL_COMPACT_EVERY = 1000  # Log records before users/vps/giveaway data is re-snapshotted
+STORAGE_BACKEND = "wal"  # "wal" (JSON snapshot + append-only log) or "sqlite"
+SQLITE_FILE = os.path.join(DATA_DIR, "bot.db")
+JOB_DB_FILE = os.path.join(DATA_DIR, "jobs.db")  # Queue shared with worker processes
 LOG_CHANNEL_ID = None
+LOG_QUEUE_SIZE = 10000  # Pending activity log entries before new ones are dropped
+LOG_BATCH_SIZE = 10  # Log entries coalesced into one channel message (Discord allows 10 embeds)
+LOG_MAX_BYTES = 5 * 1024 * 1024  # vps_logs.jsonl is rotated past this size
+LOG_BACKUPS = 10  # Rotated log files kept
+LOG_RETENTION_DAYS = 30  # Rotated log files older than this are deleted
+LOG_PRUNE_INTERVAL = 3600  # Seconds between retention checks when the log isn't rotating
+DM_INTERVAL = 0.5  # Seconds between DM sends across all senders; keeps fan-out under Discord's DM limits
+DM_CONCURRENCY = 2  # DMs in flight at once
+DM_RETRIES = 3  # Retries for a DM that hit a rate limit or a Discord/network error
+DM_BACKOFF = 5  # Seconds before the first DM retry, doubled on each further one
+USER_CACHE_SIZE = 10000  # Fetched users kept so repeated notifications skip fetch_user
+METRICS_HOST = "127.0.0.1"  # Prometheus /metrics endpoint; keep it local
+METRICS_PORT = 9464  # 0 disables the endpoint
 OWNER_ID = 1397506807089598474
 
 # Global admin sets
@@ -43,53 +122,252 @@ logger = logging.getLogger("ChunkHostBot")
 # Ensure data dir
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# Cold start timing: phase -> seconds, reported once Discord and Docker are ready
+startup_timings = {}
+
+@contextlib.contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[phase] = startup_timings.get(phase, 0) + time.perf_counter() - start
+
+def log_startup_report(stage):
+    phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup_timings.items())
+    logger.info(f"{stage} {time.perf_counter() - STARTED_AT:.2f}s after start ({phases})")
+
 # JSON helpers
 def load_json(path, default):
+    """Parsed file, or default if it doesn't exist. A corrupt file is reported and moved aside, not overwritten later"""
+    if not os.path.exists(path):
+        return default
     try:
-        if not os.path.exists(path): return default
         with open(path, 'r') as f: return json.load(f)
-    except: return default
+    except (OSError, ValueError) as e:
+        backup = f"{path}.corrupt-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
+        try:
+            os.replace(path, backup)
+        except OSError:
+            backup = None
+        logger.error(f"Could not read {path}: {e}. Using defaults" + (f"; the file was moved to {backup}" if backup else ""))
+        return default
 
 def save_json(path, data):
     tmp = path + ".tmp"
     with open(tmp, 'w') as f: json.dump(data, f, indent=2)
     os.replace(tmp, path)
 
-users = load_json(USERS_FILE, {})
-vps_db = load_json(VPS_FILE, {})
-invite_snapshot = load_json(INV_CACHE_FILE, {})
-giveaways = load_json(GIVEAWAY_FILE, {})
-renew_mode = load_json(RENEW_MODE_FILE, {"mode": "15"})
+# ---------------- Storage ----------------
+class WalStore:
+    """A dict persisted as a JSON snapshot plus an append-only log of per-key changes.
 
-def is_unique_join(user_id, inviter_id):
-    """Check if this is a unique join (not a rejoin)"""
-    uid = str(inviter_id)
-    if uid not in users:
-        return True
-    
-    unique_joins = users[uid].get('unique_joins', [])
-    return str(user_id) not in unique_joins
+    The snapshot is the same file the bot always used, so existing users.json/vps_db.json/
+    giveaways.json are picked up as-is on first run. commit(data, keys) appends one compact
+    line per changed key; every WAL_COMPACT_EVERY lines the dict is re-snapshotted off the
+    event loop and the log is dropped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.wal_path = path + ".wal"
+        self.old_wal_path = path + ".wal.1"  # log being folded into the snapshot by a compaction
+        self.wal = None
+        self.pending = 0
+        self.compacting = None
+
+    def load(self):
+        data = load_json(self.path, {})
+        for wal_path in (self.old_wal_path, self.wal_path):
+            if not os.path.exists(wal_path):
+                continue
+            with open(wal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Skipping torn record in {wal_path}")
+                        continue
+                    if "v" in rec:
+                        data[rec["k"]] = rec["v"]
+                    else:
+                        data.pop(rec["k"], None)
+                    self.pending += 1
+        return data
+
+    def commit(self, data, keys=()):
+        """Log the current value of each key (a missing key is logged as a delete); no keys = full snapshot"""
+        if not keys:
+            self.compact(data)
+            return
+        if self.wal is None:
+            self.wal = open(self.wal_path, 'a+', encoding='utf-8')
+            # Terminate a record torn by a crash so the next one starts on its own line
+            if self.wal.tell() > 0:
+                self.wal.seek(self.wal.tell() - 1)
+                if self.wal.read(1) != "\n":
+                    self.wal.write("\n")
+        lines = []
+        for key in keys:
+            rec = {"k": key, "v": data[key]} if key in data else {"k": key}
+            lines.append(json.dumps(rec, separators=(",", ":")))
+        self.wal.write("\n".join(lines) + "\n")
+        self.wal.flush()
+        self.pending += len(lines)
+        if self.pending >= WAL_COMPACT_EVERY:
+            self.compact(data)
+
+    def compact(self, data):
+        if self.compacting and not self.compacting.done():
+            return
+        # Serialize on the loop for a consistent view, then swap logs so new commits go to a fresh file
+        snapshot = json.dumps(data, separators=(",", ":"))
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+        if os.path.exists(self.wal_path) and not os.path.exists(self.old_wal_path):
+            os.replace(self.wal_path, self.old_wal_path)
+        self.pending = 0
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_snapshot(snapshot)
+            return
+        self.compacting = loop.run_in_executor(None, self._write_snapshot, snapshot)
+
+    def _write_snapshot(self, snapshot):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if os.path.exists(self.old_wal_path):
+            os.remove(self.old_wal_path)
+
+class SqliteStore:
+    """Same interface as WalStore, backed by a key -> JSON table in SQLite (WAL journal mode)"""
+    columns = {}  # Extra indexed columns: name -> function(record)
+
+    def __init__(self, conn, table):
+        self.conn = conn
+        self.table = table
+        cols = "".join(f", {name}" for name in self.columns)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL{cols})")
+        self.upsert_sql = f"INSERT OR REPLACE INTO {table} (key, value{cols}) VALUES ({', '.join('?' * (2 + len(self.columns)))})"
+
+    def load(self):
+        return {key: json.loads(value) for key, value in self.conn.execute(f"SELECT key, value FROM {self.table}")}
+
+    def is_empty(self):
+        return self.conn.execute(f"SELECT 1 FROM {self.table} LIMIT 1").fetchone() is None
+
+    def commit(self, data, keys=()):
+        """Upsert each key (delete if it's gone from data) in one transaction; no keys = replace everything"""
+        with self.conn:
+            if not keys:
+                self.clear()
+                keys = list(data)
+            for key in keys:
+                if key in data:
+                    self.upsert(key, data[key])
+                else:
+                    self.delete(key)
+
+    def compact(self, data):
+        self.commit(data)
+
+    def clear(self):
+        self.conn.execute(f"DELETE FROM {self.table}")
+
+    def delete(self, key):
+        self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def upsert(self, key, rec):
+        self.conn.execute(self.upsert_sql, (key, json.dumps(rec, separators=(",", ":")), *(fn(rec) for fn in self.columns.values())))
+
+class SqliteVpsStore(SqliteStore):
+    """VPS table with indexes on owner, shared users and expiry"""
+    columns = {
+        "owner": lambda rec: rec.get('owner'),
+        "expires_at": lambda rec: rec.get('expires_at'),
+        "active": lambda rec: int(rec.get('active', True))
+    }
+
+    def __init__(self, conn, table):
+        super().__init__(conn, table)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_owner ON {table} (owner)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_expiry ON {table} (active, expires_at)")
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table}_shares (uid TEXT, cid TEXT, PRIMARY KEY (uid, cid)) WITHOUT ROWID")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_shares_cid ON {table}_shares (cid)")
+
+    def clear(self):
+        super().clear()
+        self.conn.execute(f"DELETE FROM {self.table}_shares")
+
+    def delete(self, key):
+        super().delete(key)
+        self.conn.execute(f"DELETE FROM {self.table}_shares WHERE cid = ?", (key,))
+
+    def upsert(self, key, rec):
+        self.delete(key)
+        super().upsert(key, rec)
+        self.conn.executemany(
+            f"INSERT OR IGNORE INTO {self.table}_shares (uid, cid) VALUES (?, ?)",
+            [(uid, key) for uid in rec.get('shared_with', [])]
+        )
+
+    def cids_for_user(self, uid):
+        """Container ids the user owns or has been shared"""
+        return [row[0] for row in self.conn.execute(
+            f"SELECT key FROM {self.table} WHERE owner = ? UNION SELECT cid FROM {self.table}_shares WHERE uid = ?",
+            (uid, uid)
+        )]
+
+    def cids_by_expiry(self, before_iso=None):
+        """Active containers soonest-expiring first, optionally only those expiring by before_iso"""
+        return [row[0] for row in self.conn.execute(
+            f"SELECT key FROM {self.table} WHERE active = 1 AND expires_at <= ? ORDER BY expires_at",
+            (before_iso or "9999",)  # ISO strings sort chronologically
+        )]
+
+def open_sqlite(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+def migrate_json_to_sqlite(conn, stores):
+    """One-time import of users.json/vps_db.json/giveaways.json (plus any pending log) into SQLite"""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+        return
+    for path, store in stores:
+        data = WalStore(path).load()
+        if data and store.is_empty():
+            store.commit(data)
+            logger.info(f"Migrated {len(data)} record(s) from {path} to SQLite")
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (datetime.utcnow().isoformat(),))
+
+if STORAGE_BACKEND == "sqlite":
+    sqlite_conn = open_sqlite(SQLITE_FILE)
+    users_store = SqliteStore(sqlite_conn, "users")
+    vps_store = SqliteVpsStore(sqlite_conn, "vps")
+    giveaway_store = SqliteStore(sqlite_conn, "giveaways")
+    migrate_json_to_sqlite(sqlite_conn, [(USERS_FILE, users_store), (VPS_FILE, vps_store), (GIVEAWAY_FILE, giveaway_store)])
+else:
+    users_store = WalStore(USERS_FILE)
+    vps_store = WalStore(VPS_FILE)
+    giveaway_store = WalStore(GIVEAWAY_FILE)
+
+with timed("load data"):
+    users = users_store.load()
+    vps_db = vps_store.load()
+    invite_snapshot = load_json(INV_CACHE_FILE, {})
+    giveaways = giveaway_store.load()
+    renew_mode = load_json(RENEW_MODE_FILE, {"mode": "15"})
 
-def add_unique_join(user_id, inviter_id):
-    """Add a unique join to inviter's record"""
-    uid = str(inviter_id)
-    if uid not in users:
-        users[uid] = {
-            "points": 0, 
-            "inv_unclaimed": 0, 
-            "inv_total": 0, 
-            "invites": [],
-            "unique_joins": []
-        }
-    
-    user_id_str = str(user_id)
-    if user_id_str not in users[uid].get('unique_joins', []):
-        users[uid]['unique_joins'].append(user_id_str)
-        users[uid]['inv_unclaimed'] += 1
-        users[uid]['inv_total'] += 1
-        persist_users()
-        return True
-    return False
 # ---------------- Bot Init ----------------
 intents = discord.Intents.default()
 intents.message_content = True
@@ -97,439 +375,3013 @@ intents.guilds = True
 intents.members = True
 intents.invites = True
 
-class Bot(commands.Bot):
+class Bot(commands.AutoShardedBot):
     def __init__(self):
-        super().__init__(command_prefix="!", intents=intents)  # Changed prefix to !
+        super().__init__(command_prefix="!", intents=intents, shard_count=SHARD_COUNT)  # Changed prefix to !
 
     async def setup_hook(self):
-        # Sync commands globally
+        # Docker calls go to worker processes when enabled; must be set before nodes connect
+        if JOB_WORKERS:
+            enable_job_queue()
+            self.worker_task = asyncio.create_task(supervise_workers())
+
+        # Connect to every node, build the baked VPS image and fill the warm pools in the background
+        self.docker_prep_task = asyncio.create_task(prepare_docker_host())
+
+        # VPS expiry and giveaway end times
+        self.scheduler_task = start_deadline_scheduler()
+        self.log_task = asyncio.create_task(log_consumer())
+        self.telemetry_tasks = [asyncio.create_task(telemetry_collector(node)) for node in nodes.values()]
+        self.node_health_task = asyncio.create_task(node_health_loop())
+        self.ssh_refresh_task = tmate_sessions.start()
+        self.metrics_runner = await start_metrics_server()
+
+        with timed("command sync"):
+            await self.sync_commands()
+
+    def command_tree_hash(self):
+        # Global commands are moved to the guild on sync; counting both keeps the hash stable across that
+        commands = self.tree.get_commands() + (self.tree.get_commands(guild=discord.Object(id=GUILD_ID)) if GUILD_ID else [])
+        by_name = {c['name']: c for c in (command.to_dict(self.tree) for command in commands)}
+        return hashlib.sha256(json.dumps([GUILD_ID, sorted(by_name.items())], sort_keys=True).encode()).hexdigest()
+
+    async def sync_commands(self):
+        """Sync slash commands to GUILD_ID (instant, unlike global) and only when the tree changed"""
+        tree_hash = self.command_tree_hash()
         try:
-            synced = await self.tree.sync()
+            with open(COMMAND_HASH_FILE) as f:
+                if f.read().strip() == tree_hash:
+                    logger.info("Command tree unchanged, skipping sync")
+                    return
+        except OSError:
+            pass
+        try:
+            if GUILD_ID:
+                guild = discord.Object(id=GUILD_ID)
+                self.tree.copy_global_to(guild=guild)
+                synced = await self.tree.sync(guild=guild)
+                # Drop the global copies earlier versions registered so commands don't show twice
+                self.tree.clear_commands(guild=None)
+                await self.tree.sync()
+            else:
+                synced = await self.tree.sync()
+            with open(COMMAND_HASH_FILE, 'w') as f:
+                f.write(tree_hash)
             logger.info(f"Synced {len(synced)} command(s)")
         except Exception as e:
             logger.error(f"Failed to sync commands: {e}")
 
 bot = Bot()
 
-# ---------------- Docker Helpers ----------------
-async def docker_run_container(ram_gb, cpu, disk_gb):
-    http_port = random.randint(3000,3999)
-    name = f"vps-{random.randint(1000,9999)}"
-    
-    # FIXED: Use systemd-compatible container setup with proper image
-    cmd = [
-        "docker", "run", "-d", 
-        "--privileged",
-        "--cgroupns=host",
-        "--tmpfs", "/run",
-        "--tmpfs", "/run/lock",
-        "-v", "/sys/fs/cgroup:/sys/fs/cgroup:rw",
-        "--name", name,
-        "--cpus", str(cpu),
-        "--memory", f"{ram_gb}g",
-        "--memory-swap", f"{ram_gb}g",
-        "-p", f"{http_port}:80",
-        IMAGE  # Uses systemd-enabled image that has /sbin/init
+# ---------------- Metrics ----------------
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Histogram:
+    """Prometheus-style latency histogram with one series per label value"""
+
+    def __init__(self, name, help_text, label, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {}  # label value -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, value, seconds):
+        series = self.series.get(value)
+        if series is None:
+            series = self.series[value] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += seconds
+
+    @contextlib.contextmanager
+    def time(self, value):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(value, time.perf_counter() - start)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for value, series in sorted(self.series.items()):
+            label = f'{self.label}="{value}"'
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-2]}')
+            lines.append(f"{self.name}_sum{{{label}}} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{label}}} {series[-2]}")
+        return lines
+
+docker_latency = Histogram("bot_docker_helper_seconds", "Latency of docker helper calls", "helper")
+create_vps_latency = Histogram("bot_create_vps_stage_seconds", "Duration of each create_vps stage", "stage")
+interaction_latency = Histogram("bot_interaction_seconds", "Time from interaction creation to command completion or job defer", "command")
+persist_latency = Histogram("bot_persist_seconds", "Duration of data store writes", "store")
+scheduler_latency = Histogram("bot_scheduler_job_seconds", "Duration of scheduled expiry/giveaway jobs", "kind")
+dm_latency = Histogram("bot_dm_seconds", "Time from queueing a DM to its final outcome", "outcome")
+histograms = [docker_latency, create_vps_latency, interaction_latency, persist_latency, scheduler_latency, dm_latency]
+
+def instrumented(histogram, value):
+    """Decorator recording every call of a sync or async function in histogram under value"""
+    def wrap(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def timed_async(*args, **kwargs):
+                with histogram.time(value):
+                    return await fn(*args, **kwargs)
+            return timed_async
+
+        @functools.wraps(fn)
+        def timed_sync(*args, **kwargs):
+            with histogram.time(value):
+                return fn(*args, **kwargs)
+        return timed_sync
+    return wrap
+
+def metric_gauges():
+    """(name, help, {label string: value}) for queue depths and pool sizes, read at scrape time"""
+    return [
+        ("bot_log_queue_depth", "Activity log entries waiting to be written", {"": log_queue.qsize()}),
+        ("bot_dm_queue_depth", "DMs waiting to be sent", {"": dm_dispatcher.queue.qsize()}),
+        ("bot_job_queue_outstanding", "Docker calls waiting on worker processes", {"": len(job_queue.waiters) if job_queue else 0}),
+        ("bot_admission_reservations", "Deploys holding reserved capacity", {"": len(admission.reservations)}),
+        ("bot_admission_waiting", "Deploys queued for capacity", {"": admission.waiting}),
+        ("bot_scheduler_deadlines", "Pending expiry and giveaway deadlines", {"": len(deadline_scheduler.deadlines)}),
+        ("bot_interaction_jobs", "Interaction jobs in flight", {"": len(interaction_jobs)}),
+        ("bot_pending_joins", "Member joins waiting for an invite diff", {"": sum(len(m) for m in pending_joins.values())}),
+        ("bot_provision_tasks", "Giveaway provisioning tasks running", {"": sum(not t.done() for t in provision_tasks.values())}),
+        ("bot_vps_total", "VPS records", {"": len(vps_db)}),
+        ("bot_warm_pool_idle", "Idle warm pool containers per node", {f'node="{n}"': len(warm_pool_on(node)) for n, node in nodes.items()}),
+        ("bot_node_healthy", "Whether each node answered its last health check", {f'node="{n}"': int(bool(node.healthy)) for n, node in nodes.items()}),
     ]
-    try:
-        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        out, err = await proc.communicate()
-        if proc.returncode != 0: 
-            return None, None, f"Container creation failed: {err.decode().strip() if err else 'Unknown error'}"
-        
-        container_id = out.decode().strip()[:12] if out else None
-        if not container_id:
-            return None, None, "Failed to get container ID"
-            
-        return container_id, http_port, None
-    except Exception as e:
-        return None, None, f"Container run exception: {str(e)}"
 
-async def setup_vps_environment(container_id):
-    try:
-        # Wait for systemd to start
-        await asyncio.sleep(15)
-        
-        # Update and install essentials
-        commands = [
-            "apt-get update -y",
-            "apt-get install -y tmate curl wget neofetch sudo nano htop",
-            "systemctl enable systemd-user-sessions",
-            "systemctl start systemd-user-sessions"
-        ]
-        
-        for cmd in commands:
-            try:
-                proc = await asyncio.create_subprocess_exec(
-                    "docker", "exec", container_id, "bash", "-c", cmd,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL
-                )
-                await asyncio.wait_for(proc.communicate(), timeout=120)
-            except asyncio.TimeoutError:
-                logger.warning(f"Timeout on command: {cmd}")
-                continue
-            except Exception as e:
-                logger.warning(f"Command failed {cmd}: {e}")
-                continue
-        
-        # Test systemctl
-        test_proc = await asyncio.create_subprocess_exec(
-            "docker", "exec", container_id, "systemctl", "--version",
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        await test_proc.communicate()
-        
-        return True, None
-    except Exception as e:
-        return False, str(e)
+def metric_counters():
+    """(name, help, {label string: value}) for totals that only grow; names end in _total"""
+    return [
+        ("bot_warm_pool_claims_total", "Warm pool claims by outcome", {'outcome="hit"': warm_pool_stats["hits"], 'outcome="miss"': warm_pool_stats["misses"]}),
+    ]
 
-async def docker_exec_capture_ssh(container_id):
-    try:
-        # Kill any existing tmate sessions
-        kill_cmd = "pkill -f tmate || true"
-        proc = await asyncio.create_subprocess_exec(
-            "docker", "exec", container_id, "bash", "-c", kill_cmd,
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        )
-        await proc.communicate()
-        
-        # Generate SSH session using tmate
-        sock = f"/tmp/tmate-{container_id}.sock"
-        ssh_cmd = f"tmate -S {sock} new-session -d && sleep 5 && tmate -S {sock} display -p '#{{tmate_ssh}}'"
-        
-        proc = await asyncio.create_subprocess_exec(
-            "docker", "exec", container_id, "bash", "-c", ssh_cmd,
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await proc.communicate()
-        
-        ssh_out = stdout.decode().strip() if stdout else "ssh@tmate.io"
-        
-        return ssh_out, None
-        
-    except Exception as e:
-        return "ssh@tmate.io", str(e)
+def render_metrics():
+    lines = []
+    for histogram in histograms:
+        lines += histogram.render()
+    for kind, metrics in (("gauge", metric_gauges()), ("counter", metric_counters())):
+        for name, help_text, values in metrics:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            lines += [f"{name}{{{labels}}} {value}" if labels else f"{name} {value}" for labels, value in values.items()]
+    return "\n".join(lines) + "\n"
 
-async def docker_stop_container(container_id):
-    try:
-        proc = await asyncio.create_subprocess_exec("docker", "stop", container_id)
-        await proc.communicate()
-        return True
-    except:
-        return False
+async def start_metrics_server():
+    """Serve /metrics on METRICS_HOST:METRICS_PORT; returns the runner, or None when disabled"""
+    if not METRICS_PORT or not aiohttp:
+        return None
+    from aiohttp import web
 
-async def docker_start_container(container_id):
-    try:
-        proc = await asyncio.create_subprocess_exec("docker", "start", container_id)
-        await proc.communicate()
-        return True
-    except:
-        return False
+    async def metrics(request):
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
 
-async def docker_restart_container(container_id):
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
     try:
-        proc = await asyncio.create_subprocess_exec("docker", "restart", container_id)
-        await proc.communicate()
-        return True
-    except:
-        return False
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        logger.warning(f"Metrics endpoint not started on {METRICS_HOST}:{METRICS_PORT}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Metrics at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
 
-async def docker_remove_container(container_id):
-    try:
-        proc = await asyncio.create_subprocess_exec("docker", "rm", "-f", container_id)
-        await proc.communicate()
-        return True
-    except:
-        return False
+# ---------------- Docker Backends ----------------
+SIZE_UNITS = {"b": 1, "kb": 1000, "mb": 1000 ** 2, "gb": 1000 ** 3, "tb": 1000 ** 4,
+              "kib": 1024, "mib": 1024 ** 2, "gib": 1024 ** 3, "tib": 1024 ** 4}
 
-async def add_port_to_container(container_id, port):
-    try:
-        # Get container details to check if it exists
+def parse_size(text):
+    """'1.5GiB' / '512MB' / '0B' as docker prints them -> bytes"""
+    match = re.match(r"\s*([\d.]+)\s*([A-Za-z]*)", text)
+    if not match:
+        raise ValueError(f"Bad size: {text!r}")
+    return int(float(match.group(1)) * SIZE_UNITS.get(match.group(2).lower() or "b", 1))
+
+class DockerBackend:
+    """Interface the docker helpers talk to; one implementation per way of reaching the daemon"""
+    name = "base"
+
+    async def run_container(self, name, image, ram_gb, cpu, ports, disk_gb=None):
+        """Create and start a VPS container; ports maps container port -> host port and disk_gb
+        (if set) becomes a storage-driver quota. Returns (container_id, error)"""
+        raise NotImplementedError
+
+    async def run_sidecar(self, name, image, cmd):
+        """Create and start a helper container on the host network that Docker restarts with
+        the daemon; cmd is its argv. Returns (container_id, error)"""
+        raise NotImplementedError
+
+    async def exec(self, container_id, cmd, timeout=None):
+        """Run cmd (argv list) inside the container. Returns (returncode, stdout)"""
+        raise NotImplementedError
+
+    async def stop(self, container_id): raise NotImplementedError
+    async def start(self, container_id): raise NotImplementedError
+    async def restart(self, container_id): raise NotImplementedError
+    async def remove(self, container_id): raise NotImplementedError
+    async def update(self, container_id, ram_gb, cpu): raise NotImplementedError
+    async def rename(self, container_id, name): raise NotImplementedError
+
+    async def _each(self, op, container_ids):
+        results = await asyncio.gather(*(op(cid) for cid in container_ids), return_exceptions=True)
+        return [cid for cid, ok in zip(container_ids, results) if ok is True]
+
+    # Bulk variants return the ids that succeeded; backends with a batched call override them
+    async def stop_many(self, container_ids): return await self._each(self.stop, container_ids)
+    async def start_many(self, container_ids): return await self._each(self.start, container_ids)
+    async def remove_many(self, container_ids): return await self._each(self.remove, container_ids)
+
+    async def inspect(self, container_id):
+        """Engine-API shaped inspect dict, or None if the container doesn't exist"""
+        raise NotImplementedError
+
+    async def list_containers(self, name_prefix=""):
+        """All containers (running or not) as dicts with id, name, state and ports {container_port: host_port}"""
+        raise NotImplementedError
+
+    async def image_exists(self, tag): raise NotImplementedError
+
+    async def build_image(self, tag, dockerfile):
+        """Build tag from the DockerFile contents with an empty context. Returns (ok, error)"""
+        raise NotImplementedError
+
+    async def stream_stats(self):
+        """Async iterator of {id, cpu_percent, mem_bytes, mem_limit} for every running container, forever"""
+        raise NotImplementedError
+        yield
+
+    async def info(self):
+        """Daemon info (engine /info shape; NCPU and MemTotal are what placement uses)"""
+        raise NotImplementedError
+
+    async def ping(self): return True
+    async def close(self): pass
+
+class CLIDockerBackend(DockerBackend):
+    """Shells out to the docker binary; one fork+exec per call"""
+    name = "cli"
+
+    def __init__(self, host=None):
+        self.host_args = ["-H", host] if host else []
+
+    async def _run(self, *args, stdin=None, timeout=None):
         proc = await asyncio.create_subprocess_exec(
-            "docker", "inspect", container_id,
+            "docker", *self.host_args, *args,
+            stdin=asyncio.subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
             stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
         )
-        stdout, stderr = await proc.communicate()
-        
-        if proc.returncode != 0:
-            return False, "Container not found"
-        
-        # For simplicity, we'll just note the port in our database
-        # In production, you'd need to recreate the container with new port mappings
-        return True, f"Port {port} mapped to container"
-    except Exception as e:
-        return False, str(e)
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(stdin), timeout=timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            raise
+        return proc.returncode, out.decode() if out else "", err.decode() if err else ""
 
-async def check_systemctl_status(container_id):
-    """Check if systemctl works in the container"""
-    try:
+    async def _ok(self, *args):
+        try:
+            rc, _, _ = await self._run(*args)
+            return rc == 0
+        except:
+            return False
+
+    async def run_container(self, name, image, ram_gb, cpu, ports, disk_gb=None):
+        cmd = [
+            "run", "-d",
+            "--privileged",
+            "--cgroupns=host",
+            "--tmpfs", "/run",
+            "--tmpfs", "/run/lock",
+            "-v", "/sys/fs/cgroup:/sys/fs/cgroup:rw",
+            "--name", name,
+            "--cpus", str(cpu),
+            "--memory", f"{ram_gb}g",
+            "--memory-swap", f"{ram_gb}g",
+        ]
+        if disk_gb:
+            cmd += ["--storage-opt", f"size={disk_gb}G"]
+        for container_port, host_port in ports.items():
+            cmd += ["-p", f"{host_port}:{container_port}"]
+        rc, out, err = await self._run(*cmd, image)
+        if rc != 0:
+            return None, f"Container creation failed: {err.strip() or 'Unknown error'}"
+        return out.strip()[:12] or None, None
+
+    async def run_sidecar(self, name, image, cmd):
+        rc, out, err = await self._run("run", "-d", "--name", name, "--network", "host", "--restart", "unless-stopped", image, *cmd)
+        if rc != 0:
+            return None, f"Container creation failed: {err.strip() or 'Unknown error'}"
+        return out.strip()[:12] or None, None
+
+    async def exec(self, container_id, cmd, timeout=None):
+        rc, out, _ = await self._run("exec", container_id, *cmd, timeout=timeout)
+        return rc, out
+
+    async def stop(self, container_id): return await self._ok("stop", container_id)
+    async def start(self, container_id): return await self._ok("start", container_id)
+    async def restart(self, container_id): return await self._ok("restart", container_id)
+    async def remove(self, container_id): return await self._ok("rm", "-f", container_id)
+    async def rename(self, container_id, name): return await self._ok("rename", container_id, name)
+
+    async def _many(self, args, container_ids):
+        # docker echoes each container it handled, so one call covers the whole batch
+        _, out, _ = await self._run(*args, *container_ids)
+        handled = set(out.split())
+        return [cid for cid in container_ids if cid in handled]
+
+    async def stop_many(self, container_ids): return await self._many(["stop"], container_ids)
+    async def start_many(self, container_ids): return await self._many(["start"], container_ids)
+    async def remove_many(self, container_ids): return await self._many(["rm", "-f"], container_ids)
+
+    async def update(self, container_id, ram_gb, cpu):
+        return await self._ok("update", "--cpus", str(cpu), "--memory", f"{ram_gb}g", "--memory-swap", f"{ram_gb}g", container_id)
+
+    async def inspect(self, container_id):
+        rc, out, _ = await self._run("inspect", container_id)
+        if rc != 0:
+            return None
+        data = json.loads(out)
+        return data[0] if data else None
+
+    async def list_containers(self, name_prefix=""):
+        args = ["ps", "-a", "--no-trunc", "--format", "{{.ID}}\t{{.Names}}\t{{.State}}\t{{.Ports}}"]
+        if name_prefix:
+            args[2:2] = ["--filter", f"name=^/?{name_prefix}"]
+        rc, out, _ = await self._run(*args)
+        containers = []
+        for line in out.splitlines():
+            cid, cname, state, ports = (line.split("\t") + ["", "", ""])[:4]
+            containers.append({
+                "id": cid[:12],
+                "name": cname,
+                "state": state,
+                "ports": {int(c): int(h) for h, c in re.findall(r":(\d+)->(\d+)/tcp", ports)}
+            })
+        return containers
+
+    async def image_exists(self, tag):
+        return await self._ok("image", "inspect", tag)
+
+    async def build_image(self, tag, dockerfile):
+        rc, _, err = await self._run("build", "-t", tag, "-", stdin=dockerfile)
+        return rc == 0, (err.strip()[-500:] or "Unknown error") if rc != 0 else None
+
+    async def stream_stats(self):
+        # A single long-lived `docker stats` covers every running container
         proc = await asyncio.create_subprocess_exec(
-            "docker", "exec", container_id, "systemctl", "--version",
-            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            "docker", *self.host_args, "stats", "--format", "{{json .}}",
+            stdout=asyncio.subprocess.PIPE, stderr=subprocess.DEVNULL
         )
-        stdout, stderr = await proc.communicate()
-        return proc.returncode == 0
-    except:
-        return False
+        try:
+            async for raw in proc.stdout:
+                # Frames are separated by terminal clear-screen sequences
+                line = re.sub(r"\x1b\[[0-9;]*[A-Za-z]", "", raw.decode(errors="replace")).strip()
+                if not line:
+                    continue
+                try:
+                    stat = json.loads(line)
+                    used, limit = (parse_size(p) for p in stat["MemUsage"].split("/"))
+                    yield {
+                        "id": stat["ID"][:12],
+                        "cpu_percent": float(stat["CPUPerc"].rstrip("%") or 0),
+                        "mem_bytes": used,
+                        "mem_limit": limit
+                    }
+                except (ValueError, KeyError):
+                    continue
+        finally:
+            if proc.returncode is None:
+                proc.kill()
 
-# ---------------- VPS Helpers ----------------
-def persist_vps(): save_json(VPS_FILE, vps_db)
-def persist_users(): save_json(USERS_FILE, users)
-def persist_renew_mode(): save_json(RENEW_MODE_FILE, renew_mode)
-def persist_giveaways(): save_json(GIVEAWAY_FILE, giveaways)
+    async def info(self):
+        rc, out, _ = await self._run("info", "--format", "{{json .}}")
+        return json.loads(out) if rc == 0 else {}
 
-async def send_log(action: str, user, details: str = "", vps_id: str = ""):
-    """Send professional log embed to log channel"""
-    if not LOG_CHANNEL_ID:
-        return
-    
-    try:
-        channel = bot.get_channel(LOG_CHANNEL_ID)
-        if not channel:
-            print(f"Log channel {LOG_CHANNEL_ID} not found")
-            return
-        
-        # Determine color based on action type
-        color_map = {
-            "deploy": discord.Color.green(),
-            "remove": discord.Color.orange(),
-            "renew": discord.Color.blue(),
-            "suspend": discord.Color.red(),
-            "unsuspend": discord.Color.green(),
-            "start": discord.Color.green(),
-            "stop": discord.Color.orange(),
-            "restart": discord.Color.blue(),
-            "share": discord.Color.purple(),
-            "admin": discord.Color.gold(),
-            "points": discord.Color.teal(),
-            "invite": discord.Color.magenta(),
-            "error": discord.Color.red()
-        }
-        
-        # Get appropriate color
-        action_lower = action.lower()
-        color = discord.Color.blue()  # default
-        for key, value in color_map.items():
-            if key in action_lower:
-                color = value
-                break
-        
-        # Create embed
-        embed = discord.Embed(
-            title=f"📊 {action}",
-            color=color,
-            timestamp=datetime.utcnow()
-        )
-        
-        # Add user info
-        if hasattr(user, 'mention'):
-            embed.add_field(name="👤 User", value=f"{user.mention}\n`{user.name}`", inline=True)
+class EngineDockerBackend(DockerBackend):
+    """Talks to the Docker Engine API (unix socket or tcp://) with a pooled keep-alive HTTP session"""
+    name = "engine"
+
+    def __init__(self, endpoint=f"unix://{DOCKER_SOCKET}", pool_size=DOCKER_API_POOL_SIZE):
+        self.endpoint = endpoint
+        self.pool_size = pool_size
+        self.session = None
+        if endpoint.startswith("unix://"):
+            self.base_url = "http://docker"
         else:
-            embed.add_field(name="👤 User", value=f"`{user}`", inline=True)
-        
-        # Add VPS ID if provided
-        if vps_id:
-            embed.add_field(name="🆔 VPS ID", value=f"`{vps_id}`", inline=True)
-        
-        # Add details
-        if details:
-            embed.add_field(name="📝 Details", value=details[:1024], inline=False)
-        
-        # Add timestamp field
-        embed.add_field(
-            name="⏰ Time", 
-            value=f"<t:{int(datetime.utcnow().timestamp())}:R>", 
-            inline=True
-        )
-        
-        # Set footer
-        embed.set_footer(text="VPS Activity Log")
-        
-        await channel.send(embed=embed)
-        
-        # Also save to JSON file for /logs command
-        logs_file = os.path.join(DATA_DIR, "vps_logs.json")
-        logs_data = load_json(logs_file, [])
-        
-        log_entry = {
-            "timestamp": datetime.utcnow().isoformat(),
-            "action": action,
-            "user": user.name if hasattr(user, 'name') else str(user),
-            "details": details,
-            "vps_id": vps_id
-        }
-        
-        logs_data.append(log_entry)
-        
-        # Keep only last 1000 logs to prevent file from growing too large
-        if len(logs_data) > 1000:
-            logs_data = logs_data[-1000:]
-        
-        save_json(logs_file, logs_data)
-        
-    except Exception as e:
-        print(f"Failed to send log: {e}")
+            self.base_url = "http://" + endpoint.split("://", 1)[-1]
 
-async def create_vps(owner_id, ram=DEFAULT_RAM_GB, cpu=DEFAULT_CPU, disk=DEFAULT_DISK_GB, paid=False, giveaway=False):
-    uid = str(owner_id)
-    cid, http_port, err = await docker_run_container(ram, cpu, disk)
-    if err: 
-        return {'error': err}
-    
-    # Wait for container to start and setup
-    await asyncio.sleep(10)
-    
-    # Setup environment
-    success, setup_err = await setup_vps_environment(cid)
-    if not success:
-        logger.warning(f"Setup had issues for {cid}: {setup_err}")
-    
-    # Generate SSH
-    ssh, ssh_err = await docker_exec_capture_ssh(cid)
-    
-    # Check systemctl status
-    systemctl_works = await check_systemctl_status(cid)
-    
-    created = datetime.utcnow()
-    expires = created + timedelta(days=VPS_LIFETIME_DAYS)
-    rec = {
-        "owner": uid,
-        "container_id": cid,
-        "ram": ram,
-        "cpu": cpu,
-        "disk": disk,
-        "http_port": http_port,
-        "ssh": ssh,
-        "created_at": created.isoformat(),
-        "expires_at": expires.isoformat(),
-        "active": True,
-        "suspended": False,
-        "paid_plan": paid,
-        "giveaway_vps": giveaway,
-        "shared_with": [],
-        "additional_ports": [],
-        "systemctl_working": systemctl_works
-    }
-    vps_db[cid] = rec
-    persist_vps()
-    
-    # Send log
-    try:
-        user = await bot.fetch_user(int(uid))
-        await send_log("VPS Created", user, cid, f"RAM: {ram}GB, CPU: {cpu}, Disk: {disk}GB, Systemctl: {'✅' if systemctl_works else '❌'}")
-    except:
-        pass
-    
-    return rec
+    def _session(self):
+        if self.session is None or self.session.closed:
+            if self.endpoint.startswith("unix://"):
+                connector = aiohttp.UnixConnector(path=self.endpoint[len("unix://"):], limit=self.pool_size)
+            else:
+                connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10)
+            )
+        return self.session
 
-def get_user_vps(user_id):
-    uid = str(user_id)
-    return [vps for vps in vps_db.values() if vps['owner'] == uid or uid in vps.get('shared_with', [])]
+    async def _request(self, method, path, timeout=None, raw=False, **kwargs):
+        """Returns (status, body) where body is parsed JSON when the daemon sent JSON (unless raw)"""
+        async def call():
+            async with self._session().request(method, f"{self.base_url}{path}", **kwargs) as resp:
+                if resp.content_type == "application/json" and not raw:
+                    return resp.status, await resp.json()
+                return resp.status, await resp.read()
+        return await asyncio.wait_for(call(), timeout=timeout)
 
-def can_manage_vps(user_id, container_id):
-    if user_id in ADMIN_IDS:
-        return True
-    vps = vps_db.get(container_id)
-    if not vps:
-        return False
-    uid = str(user_id)
-    return vps['owner'] == uid or uid in vps.get('shared_with', [])
+    async def _ok(self, method, path, **kwargs):
+        try:
+            status, _ = await self._request(method, path, **kwargs)
+            return status < 300 or status == 304  # 304: already in the requested state
+        except Exception as e:
+            logger.debug(f"Docker API {method} {path} failed: {e}")
+            return False
 
-def get_resource_usage():
-    """Calculate resource usage percentages"""
-    total_ram = sum(vps['ram'] for vps in vps_db.values())
-    total_cpu = sum(vps['cpu'] for vps in vps_db.values())
-    total_disk = sum(vps['disk'] for vps in vps_db.values())
-    
-    ram_percent = (total_ram / (DEFAULT_RAM_GB * 100)) * 100  # Assuming 100GB max RAM
-    cpu_percent = (total_cpu / (DEFAULT_CPU * 50)) * 100     # Assuming 50 CPU max
-    disk_percent = (total_disk / (DEFAULT_DISK_GB * 200)) * 100  # Assuming 200GB max disk
-    
-    return {
-        'ram': min(ram_percent, 100),
-        'cpu': min(cpu_percent, 100),
-        'disk': min(disk_percent, 100),
-        'total_ram': total_ram,
-        'total_cpu': total_cpu,
-        'total_disk': total_disk
-    }
+    @staticmethod
+    def _demux(raw):
+        """Collect stdout frames from a non-TTY attach stream (8-byte header per frame)"""
+        out, i = bytearray(), 0
+        while i + 8 <= len(raw):
+            stream, size = raw[i], int.from_bytes(raw[i + 4:i + 8], "big")
+            if stream == 1:
+                out += raw[i + 8:i + 8 + size]
+            i += 8 + size
+        return out.decode(errors="replace")
 
-# ---------------- Background Tasks ----------------
-@tasks.loop(minutes=10)
-async def expire_check_loop():
-    now = datetime.utcnow()
-    changed = False
-    for cid, rec in list(vps_db.items()):
-        if rec.get('active', True) and now >= datetime.fromisoformat(rec['expires_at']):
-            await docker_stop_container(cid)
-            rec['active'] = False
-            rec['suspended'] = True
-            changed = True
-            # Log expiration
-            try:
-                user = await bot.fetch_user(int(rec['owner']))
-                await send_log("VPS Expired", user, cid, "Auto-suspended due to expiry")
-            except:
-                pass
-    if changed: 
-        persist_vps()
+    async def run_container(self, name, image, ram_gb, cpu, ports, disk_gb=None):
+        body = {
+            "Image": image,
+            "ExposedPorts": {f"{p}/tcp": {} for p in ports},
+            "HostConfig": {
+                "Privileged": True,
+                "CgroupnsMode": "host",
+                "Tmpfs": {"/run": "", "/run/lock": ""},
+                "Binds": ["/sys/fs/cgroup:/sys/fs/cgroup:rw"],
+                "NanoCpus": int(float(cpu) * 1e9),
+                "Memory": int(ram_gb * 1024 ** 3),
+                "MemorySwap": int(ram_gb * 1024 ** 3),
+                "PortBindings": {f"{p}/tcp": [{"HostPort": str(h)}] for p, h in ports.items()}
+            }
+        }
+        if disk_gb:
+            body["HostConfig"]["StorageOpt"] = {"size": f"{disk_gb}G"}
+        return await self._create_and_start(name, image, body)
 
-@tasks.loop(minutes=5)
-async def giveaway_check_loop():
-    now = datetime.utcnow()
-    ended_giveaways = []
+    async def run_sidecar(self, name, image, cmd):
+        return await self._create_and_start(name, image, {
+            "Image": image,
+            "Cmd": cmd,
+            "HostConfig": {"NetworkMode": "host", "RestartPolicy": {"Name": "unless-stopped"}}
+        })
+
+    async def _create_and_start(self, name, image, body):
+        try:
+            status, data = await self._request("POST", "/containers/create", params={"name": name}, json=body)
+            if status == 404:
+                # Image not present locally; pull it the way `docker run` would
+                repo, _, tag = image.rpartition(":") if ":" in image.split("/")[-1] else (image, "", "latest")
+                await self._request("POST", "/images/create", raw=True, params={"fromImage": repo, "tag": tag})
+                status, data = await self._request("POST", "/containers/create", params={"name": name}, json=body)
+            if status >= 300:
+                return None, f"Container creation failed: {data.get('message', status) if isinstance(data, dict) else status}"
+            cid = data["Id"][:12]
+            status, data = await self._request("POST", f"/containers/{cid}/start")
+            if status >= 300 and status != 304:
+                await self.remove(cid)
+                return None, f"Container start failed: {data.get('message', status) if isinstance(data, dict) else status}"
+            return cid, None
+        except Exception as e:
+            return None, f"Container run exception: {str(e)}"
+
+    async def exec(self, container_id, cmd, timeout=None):
+        status, data = await self._request(
+            "POST", f"/containers/{container_id}/exec",
+            json={"Cmd": cmd, "AttachStdout": True, "AttachStderr": True}
+        )
+        if status >= 300:
+            return -1, ""
+        exec_id = data["Id"]
+        _, raw = await self._request("POST", f"/exec/{exec_id}/start", timeout=timeout, raw=True, json={"Detach": False, "Tty": False})
+        _, info = await self._request("GET", f"/exec/{exec_id}/json")
+        return info.get("ExitCode", -1), self._demux(raw)
+
+    async def stop(self, container_id): return await self._ok("POST", f"/containers/{container_id}/stop")
+    async def start(self, container_id): return await self._ok("POST", f"/containers/{container_id}/start")
+    async def restart(self, container_id): return await self._ok("POST", f"/containers/{container_id}/restart")
+    async def remove(self, container_id): return await self._ok("DELETE", f"/containers/{container_id}", params={"force": "1"})
+    async def rename(self, container_id, name): return await self._ok("POST", f"/containers/{container_id}/rename", params={"name": name})
+
+    async def update(self, container_id, ram_gb, cpu):
+        return await self._ok("POST", f"/containers/{container_id}/update", json={
+            "NanoCpus": int(float(cpu) * 1e9),
+            "Memory": int(ram_gb * 1024 ** 3),
+            "MemorySwap": int(ram_gb * 1024 ** 3)
+        })
+
+    async def inspect(self, container_id):
+        status, data = await self._request("GET", f"/containers/{container_id}/json")
+        return data if status == 200 else None
+
+    async def list_containers(self, name_prefix=""):
+        params = {"all": "1"}
+        if name_prefix:
+            params["filters"] = json.dumps({"name": [f"^/?{name_prefix}"]})
+        status, data = await self._request("GET", "/containers/json", params=params)
+        if status != 200:
+            return []
+        return [{
+            "id": c["Id"][:12],
+            "name": (c.get("Names") or ["/"])[0].lstrip("/"),
+            "state": c.get("State", ""),
+            "ports": {p["PrivatePort"]: p["PublicPort"] for p in c.get("Ports", []) if p.get("PublicPort") and p.get("Type") == "tcp"}
+        } for c in data]
+
+    async def image_exists(self, tag):
+        try:
+            status, _ = await self._request("GET", f"/images/{tag}/json")
+            return status == 200
+        except:
+            return False
+
+    async def build_image(self, tag, dockerfile):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            info = tarfile.TarInfo("Dockerfile")
+            info.size = len(dockerfile)
+            tar.addfile(info, io.BytesIO(dockerfile))
+        try:
+            status, body = await self._request(
+                "POST", "/build", raw=True, params={"t": tag}, data=buf.getvalue(),
+                headers={"Content-Type": "application/x-tar"}
+            )
+        except Exception as e:
+            return False, str(e)
+        # The build streams JSON progress lines; a failed step shows up as an "error" line
+        for line in body.decode(errors="replace").splitlines():
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if "error" in msg:
+                return False, msg["error"][-500:]
+        return status == 200, None if status == 200 else f"Build failed with HTTP {status}"
+
+    async def container_stats(self, container_id):
+        status, data = await self._request("GET", f"/containers/{container_id}/stats", params={"stream": "false"})
+        if status != 200:
+            return None
+        cpu, precpu = data.get("cpu_stats", {}), data.get("precpu_stats", {})
+        cpu_delta = cpu.get("cpu_usage", {}).get("total_usage", 0) - precpu.get("cpu_usage", {}).get("total_usage", 0)
+        system_delta = cpu.get("system_cpu_usage", 0) - precpu.get("system_cpu_usage", 0)
+        online = cpu.get("online_cpus") or len(cpu.get("cpu_usage", {}).get("percpu_usage") or [1])
+        mem = data.get("memory_stats", {})
+        # Same as `docker stats`: page cache doesn't count as used memory
+        cache = mem.get("stats", {}).get("inactive_file", mem.get("stats", {}).get("cache", 0))
+        return {
+            "id": container_id,
+            "cpu_percent": cpu_delta / system_delta * online * 100 if system_delta > 0 else 0.0,
+            "mem_bytes": max(mem.get("usage", 0) - cache, 0),
+            "mem_limit": mem.get("limit", 0)
+        }
+
+    async def stream_stats(self):
+        # The API has no all-container stream, so take one concurrent sample per container over the pooled session
+        while True:
+            running = [c["id"] for c in await self.list_containers() if c["state"] == "running"]
+            for stat in await asyncio.gather(*(self.container_stats(cid) for cid in running), return_exceptions=True):
+                if isinstance(stat, dict):
+                    yield stat
+            await asyncio.sleep(TELEMETRY_INTERVAL)
+
+    async def info(self):
+        status, data = await self._request("GET", "/info", timeout=10)
+        return data if status == 200 else {}
+
+    async def ping(self):
+        return await self._ok("GET", "/_ping", timeout=5)
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+class FakeDockerBackend(DockerBackend):
+    """In-memory daemon for tests; exec answers come from exec_outputs keyed by a substring of the command"""
+    name = "fake"
+
+    def __init__(self, ncpu=8, mem_gb=32):
+        self.ncpu = ncpu
+        self.mem_gb = mem_gb
+        self.up = True  # Flip to False to make ping() fail
+        self.containers = {}
+        self.images = set()
+        self.calls = []
+        self.ips_handed_out = 0
+        self.exec_outputs = {"is-system-running": "running", "tmate_ssh": "ssh fake@nyc1.tmate.io"}
+
+    def _get(self, container_id):
+        for cid, c in self.containers.items():
+            if cid == container_id or c["name"] == container_id:
+                return cid, c
+        return None, None
+
+    async def run_container(self, name, image, ram_gb, cpu, ports, disk_gb=None):
+        self.calls.append(("run", name))
+        if any(c["name"] == name for c in self.containers.values()):
+            return None, f"Container creation failed: name {name} is already in use"
+        taken = {port for c in self.containers.values() for port in c["ports"].values()}
+        clash = next((port for port in ports.values() if port in taken), None)
+        if clash is not None:
+            return None, f"Bind for 0.0.0.0:{clash} failed: port is already allocated"
+        cid = hashlib.sha256(f"{name}-{len(self.calls)}".encode()).hexdigest()[:12]
+        self.containers[cid] = {"name": name, "image": image, "state": "running", "ram": ram_gb, "cpu": cpu, "disk": disk_gb, "ports": dict(ports), "ip": self._next_ip()}
+        return cid, None
+
+    async def run_sidecar(self, name, image, cmd):
+        self.calls.append(("run_sidecar", name))
+        if any(c["name"] == name for c in self.containers.values()):
+            return None, f"Container creation failed: name {name} is already in use"
+        # Like socat on the host network, it exits at once if its TCP-LISTEN port is taken
+        listen = next((int(arg.split(":")[1].split(",")[0]) for arg in cmd if arg.startswith("TCP-LISTEN:")), None)
+        taken = {port for c in self.containers.values() if c["state"] == "running" for port in [*c["ports"].values(), c.get("listen")]}
+        cid = hashlib.sha256(f"{name}-{len(self.calls)}".encode()).hexdigest()[:12]
+        self.containers[cid] = {
+            "name": name, "image": image, "state": "exited" if listen in taken else "running",
+            "ram": 0, "cpu": 0, "disk": None, "ports": {}, "cmd": list(cmd), "listen": listen
+        }
+        return cid, None
+
+    def _next_ip(self):
+        self.ips_handed_out += 1
+        return f"172.17.{self.ips_handed_out // 250}.{self.ips_handed_out % 250 + 2}"
+
+    async def exec(self, container_id, cmd, timeout=None):
+        self.calls.append(("exec", container_id, cmd))
+        _, c = self._get(container_id)
+        if not c or c["state"] != "running":
+            return 1, ""
+        joined = " ".join(cmd)
+        for key, out in self.exec_outputs.items():
+            if key in joined:
+                return 0, out
+        return 0, ""
+
+    async def _set_state(self, op, container_id, state):
+        self.calls.append((op, container_id))
+        _, c = self._get(container_id)
+        if c:
+            # Like the bridge network, a started container may come back on another IP
+            if c["state"] != "running" and state == "running" and "ip" in c:
+                c["ip"] = self._next_ip()
+            c["state"] = state
+        return c is not None
+
+    async def stop(self, container_id): return await self._set_state("stop", container_id, "exited")
+    async def start(self, container_id): return await self._set_state("start", container_id, "running")
+    async def restart(self, container_id): return await self._set_state("restart", container_id, "running")
+
+    async def remove(self, container_id):
+        self.calls.append(("remove", container_id))
+        cid, _ = self._get(container_id)
+        return self.containers.pop(cid, None) is not None
+
+    async def update(self, container_id, ram_gb, cpu):
+        self.calls.append(("update", container_id))
+        _, c = self._get(container_id)
+        if c:
+            c.update(ram=ram_gb, cpu=cpu)
+        return c is not None
+
+    async def rename(self, container_id, name):
+        self.calls.append(("rename", container_id, name))
+        _, c = self._get(container_id)
+        if not c or any(o["name"] == name for o in self.containers.values()):
+            return False
+        c["name"] = name
+        return True
+
+    async def inspect(self, container_id):
+        cid, c = self._get(container_id)
+        if not c:
+            return None
+        running = c["state"] == "running"
+        return {
+            "Id": cid, "Name": f"/{c['name']}", "State": {"Status": c["state"], "Running": running},
+            "Config": {"Cmd": c.get("cmd")}, "NetworkSettings": {"IPAddress": c.get("ip", "") if running else ""}
+        }
+
+    async def list_containers(self, name_prefix=""):
+        return [
+            {"id": cid, "name": c["name"], "state": c["state"], "ports": dict(c["ports"])}
+            for cid, c in self.containers.items() if c["name"].startswith(name_prefix)
+        ]
+
+    async def image_exists(self, tag): return tag in self.images
+
+    async def stream_stats(self):
+        while True:
+            for cid, c in list(self.containers.items()):
+                if c["state"] == "running":
+                    yield {"id": cid, "cpu_percent": c.get("cpu_percent", 0.0), "mem_bytes": c.get("mem_bytes", 0), "mem_limit": int(c["ram"] * 1024 ** 3)}
+            await asyncio.sleep(TELEMETRY_INTERVAL)
+
+    async def build_image(self, tag, dockerfile):
+        self.images.add(tag)
+        return True, None
+
+    async def info(self):
+        return {"NCPU": self.ncpu, "MemTotal": int(self.mem_gb * 1024 ** 3)}
+
+    async def ping(self):
+        return self.up
+
+def make_docker_backend(endpoint):
+    """Backend for a node endpoint: in-memory for fake://, otherwise the engine API unless DOCKER_BACKEND says cli"""
+    if endpoint.startswith("fake://"):
+        return FakeDockerBackend()
+    if DOCKER_BACKEND == "cli" or not aiohttp:
+        return CLIDockerBackend(endpoint)
+    if DOCKER_BACKEND == "auto" and endpoint.startswith("unix://") and not os.path.exists(endpoint[len("unix://"):]):
+        return CLIDockerBackend(endpoint)
+    return EngineDockerBackend(endpoint)
+
+# ---------------- Port & Name Allocation ----------------
+class SlotAllocator:
+    """Set of free integers in a range: O(1) allocate, reserve and free"""
+
+    def __init__(self, start, end):
+        self.start, self.end = start, end
+        self.free = set(range(start, end + 1))
+
+    def allocate(self):
+        return self.free.pop() if self.free else None
+
+    def reserve(self, n):
+        self.free.discard(n)
+
+    def release(self, n):
+        if self.start <= n <= self.end:
+            self.free.add(n)
+
+# HTTP ports are per node (see DockerNode); forwarded ports and name numbers are fleet-wide, so
+# a forwarded port or VPS name identifies one container whichever node it is on.
+forward_ports = SlotAllocator(*FORWARD_PORT_RANGE)
+name_numbers = SlotAllocator(1000, 9999)  # vps-NNNN / vps-pool-NNNN
+container_slots = {}  # container_id -> {"node": node name, "name": NNNN or None, "ports": set of host ports}
+
+def claim_slots(node, container_id, name_number=None, ports=()):
+    """Mark a container's name number and host ports on `node` as taken"""
+    slots = container_slots.setdefault(container_id, {"node": node.name, "name": None, "ports": set()})
+    if name_number is not None:
+        name_numbers.reserve(name_number)
+        slots["name"] = name_number
+    for port in ports:
+        node.http_ports.reserve(port)
+        forward_ports.reserve(port)
+        slots["ports"].add(port)
+
+def release_slots(container_id):
+    slots = container_slots.pop(container_id, None)
+    if not slots:
+        return
+    if slots["name"] is not None:
+        name_numbers.release(slots["name"])
+    node = nodes.get(slots["node"])
+    for port in slots["ports"]:
+        if node:
+            node.http_ports.release(port)
+        forward_ports.release(port)
+
+def name_number(name):
+    match = re.fullmatch(r"/?vps(?:-pool)?-(\d+)", name or "")
+    return int(match.group(1)) if match else None
+
+def load_slots_from_vps_db():
+    for cid, rec in vps_db.items():
+        ports = [rec['http_port']] if rec.get('http_port') else []
+        ports += rec.get('port_map', {}).values()
+        claim_slots(node_for(cid), cid, name_number(rec.get('name')), ports)
+
+def load_slots_from_docker(node, containers):
+    """Reserve the names and published ports of every existing container on the node, ours or not"""
+    for c in containers:
+        claim_slots(node, c["id"], name_number(c["name"]), c["ports"].values())
+
+class PortForwarder:
+    """Maps a node's host port to a port inside a container with a socat sidecar.
+
+    Docker can't add published ports to an existing container, so each additional port gets a
+    vps-fwd-<host port> container on the node's host network relaying to the VPS's bridge IP.
+    Tenant traffic never passes through the bot, and the sidecars outlive bot restarts. A VPS
+    can come back on another IP, so its sidecars are removed when it stops and recreated on start.
+    """
+
+    @staticmethod
+    def sidecar_name(host_port):
+        return f"vps-fwd-{host_port}"
+
+    async def container_ip(self, container_id):
+        """Bridge IP of a running container, or None"""
+        info = await node_for(container_id).backend.inspect(container_id) or {}
+        if not info.get("State", {}).get("Running"):
+            return None
+        net = info.get("NetworkSettings", {})
+        return net.get("IPAddress") or next((n.get("IPAddress") for n in net.get("Networks", {}).values() if n.get("IPAddress")), None)
+
+    async def open(self, host_port, container_id, container_port):
+        """Start the sidecar for host_port unless one already relays to the container's current IP"""
+        ip = await self.container_ip(container_id)
+        if not ip:
+            # Never hand socat an empty address: it would relay to the node itself
+            return False, "Container has no IP address (is it running?)"
+        node = node_for(container_id)
+        name = self.sidecar_name(host_port)
+        cmd = [f"TCP-LISTEN:{host_port},fork,reuseaddr", f"TCP:{ip}:{container_port}"]
+        current = await node.backend.inspect(name)
+        if current and current.get("State", {}).get("Running") and current.get("Config", {}).get("Cmd") == cmd:
+            return True, None
+        if current:
+            await node.backend.remove(name)
+        sidecar_id, err = await node.backend.run_sidecar(name, FORWARD_IMAGE, cmd)
+        if err:
+            return False, err
+        # socat exits straight away when the port is taken on the node
+        await asyncio.sleep(FORWARD_BIND_GRACE)
+        if not ((await node.backend.inspect(sidecar_id)) or {}).get("State", {}).get("Running"):
+            await node.backend.remove(sidecar_id)
+            return False, f"Port {host_port} is in use on {node.name}"
+        return True, None
+
+    async def close(self, node, host_ports):
+        await asyncio.gather(*(node.backend.remove(self.sidecar_name(p)) for p in host_ports), return_exceptions=True)
+
+    async def close_container(self, container_id):
+        """Remove the sidecars of every host port forwarded to the container"""
+        host_ports = set(vps_db.get(container_id, {}).get('port_map', {}).values())
+        host_ports |= {p for p in container_slots.get(container_id, {}).get("ports", ()) if FORWARD_PORT_RANGE[0] <= p <= FORWARD_PORT_RANGE[1]}
+        if host_ports:
+            await self.close(node_for(container_id), host_ports)
+
+    async def open_container(self, container_id):
+        """Re-open the forwards in the VPS's port_map, e.g. after it was started"""
+        for port, host_port in vps_db.get(container_id, {}).get('port_map', {}).items():
+            ok, err = await self.open(host_port, container_id, int(port))
+            if not ok:
+                logger.warning(f"Could not forward {host_port} to port {port} of {container_id}: {err}")
+
+port_forwarder = PortForwarder()
+
+async def restore_port_forwards():
+    """Forward every running VPS's additional_ports, allocating host ports for ones never mapped;
+    stopped and suspended VPSes get their forwards closed instead"""
+    for cid, rec in list(vps_db.items()):
+        if rec.get('suspended') or not rec.get('active', True):
+            if rec.get('port_map'):
+                await port_forwarder.close_container(cid)
+            continue
+        for port in rec.get('additional_ports', []):
+            ok, msg = await add_port_to_container(cid, port)
+            if not ok:
+                logger.warning(f"Could not forward port {port} for {cid}: {msg}")
+
+# ---------------- Nodes ----------------
+class DockerNode:
+    """A Docker host VPSes can be placed on: its backend, public address, HTTP ports and health"""
+
+    def __init__(self, name, endpoint, public_ip=SERVER_IP):
+        self.name = name
+        self.endpoint = endpoint
+        self.public_ip = public_ip
+        self.backend = make_docker_backend(endpoint)
+        self.http_ports = SlotAllocator(*HTTP_PORT_RANGE)
+        self.image = None  # Tag of the baked image once ensure_vps_image() has it on this node
+        self.disk_quota_supported = None  # None until a deploy shows whether the storage driver takes size quotas
+        self.info = {}  # Last docker info
+        self.healthy = None  # None until the first health check
+        self.draining = False  # No new VPSes or pool containers while set
+        self.prepared = False  # Slots and warm pool loaded; VPSes can be placed here
+        self.image_task = None  # Background ensure_vps_image; deploys use IMAGE plus the apt bootstrap meanwhile
+
+    @property
+    def is_local(self):
+        """Whether the daemon runs on the bot's own host, so host resources can be read from the OS"""
+        return self.endpoint.startswith("unix://")
+
+    def capacity(self):
+        """CPU/RAM/disk for admission: from the OS for the local daemon, from docker info (no disk) otherwise"""
+        if self.is_local:
+            return host_capacity()
+        return {
+            'cpus': self.info.get('NCPU', 0),
+            'ram_gb': self.info.get('MemTotal', 0) / 1024 ** 3,
+            'ram_available_gb': None,
+            'disk_gb': None,
+            'disk_used_gb': None
+        }
+
+nodes = {name: DockerNode(name, cfg["endpoint"], cfg.get("public_ip", SERVER_IP)) for name, cfg in NODES.items()}
+DEFAULT_NODE = next(iter(nodes))  # Owner of records saved before nodes existed
+
+def node_for(container_id):
+    """Node that owns a container: from its VPS record, else from its slots, else the default node"""
+    rec = vps_db.get(container_id)
+    name = rec.get('node') if rec else None
+    if name is None:
+        name = container_slots.get(container_id, {}).get("node")
+    return nodes.get(name) or nodes[DEFAULT_NODE]
+
+def placeable_nodes():
+    return [node for node in nodes.values() if node.prepared and node.healthy and not node.draining]
+
+def load_node_state():
+    for name, state in load_json(NODE_STATE_FILE, {}).items():
+        if name in nodes:
+            nodes[name].draining = state.get('draining', False)
+
+def persist_node_state():
+    save_json(NODE_STATE_FILE, {name: {'draining': node.draining} for name, node in nodes.items()})
+
+async def set_node_draining(name, draining=True):
+    """Stop (or resume) placing VPSes on a node; existing VPSes stay where they are"""
+    node = nodes.get(name)
+    if not node:
+        return False, f"Unknown node {name}"
+    node.draining = draining
+    persist_node_state()
+    if draining:
+        # Idle pool containers there would never be claimed. Take them all out of the pool before
+        # the first await so a deploy claiming from it meanwhile can't race the removals.
+        idle = warm_pool_on(node)
+        warm_pool[:] = [entry for entry in warm_pool if entry not in idle]
+        for cid, _ in idle:
+            await docker_remove_container(cid)
+    else:
+        admission.notify()
+        schedule_warm_pool_refill()
+    logger.info(f"Node {name} {'draining' if draining else 'accepting VPSes again'}")
+    return True, None
+
+async def check_node(node):
+    """Ping the node and refresh its docker info; returns whether it is healthy"""
+    try:
+        healthy = await node.backend.ping()
+        if healthy:
+            node.info = await node.backend.info() or node.info
+    except Exception as e:
+        logger.debug(f"Health check failed for node {node.name}: {e}")
+        healthy = False
+    if healthy != node.healthy:
+        if healthy:
+            logger.info(f"Node {node.name} is up ({node.backend.name} backend)")
+        else:
+            logger.warning(f"Node {node.name} at {node.endpoint} is unreachable")
+    node.healthy = healthy
+    return healthy
+
+async def connect_node(node):
+    """Fall back to the docker CLI if the engine API doesn't answer, and route through workers when enabled"""
+    if isinstance(node.backend, EngineDockerBackend) and DOCKER_BACKEND == "auto" and not await node.backend.ping():
+        logger.warning(f"Docker API at {node.endpoint} not reachable, falling back to the docker CLI")
+        await node.backend.close()
+        node.backend = CLIDockerBackend(node.endpoint)
+    if job_queue and not isinstance(node.backend, QueuedDockerBackend):
+        node.backend = QueuedDockerBackend(node.backend, job_queue, node.name)
+
+async def prepare_node(node):
+    """Load what a node already runs and bring its image and warm pool up; retried until the node answers.
+
+    Returns the node's container listing (also used by the startup reconcile), or None.
+    """
+    if not node.prepared:
+        await connect_node(node)
+    if not await check_node(node):
+        return None
+    try:
+        containers = await node.backend.list_containers()
+    except Exception as e:
+        logger.warning(f"Failed to list containers on {node.name}: {e}")
+        containers = None
+    if containers is not None:
+        load_slots_from_docker(node, containers)
+        await adopt_warm_pool(node, containers)
+    node.prepared = True
+    if node.image is None and (node.image_task is None or node.image_task.done()):
+        node.image_task = asyncio.create_task(bake_node_image(node))
+    # Deploys may be queued waiting for a node
+    admission.notify()
+    return containers
+
+async def bake_node_image(node):
+    """Build the node's VPS image without holding up deploys, then fill its warm pool from it"""
+    if await ensure_vps_image(node):
+        schedule_warm_pool_refill()
+
+async def node_health_loop():
+    """Re-check every node periodically; nodes that come back are prepared and refilled"""
+    while True:
+        await asyncio.sleep(NODE_HEALTH_INTERVAL)
+        before = {name for name, node in nodes.items() if node.healthy}
+        await asyncio.gather(*(check_node(node) if node.prepared else prepare_node(node) for node in nodes.values()))
+        if {name for name, node in nodes.items() if node.healthy} - before:
+            admission.notify()
+            schedule_warm_pool_refill()
+
+with timed("build indexes"):
+    load_node_state()
+    load_slots_from_vps_db()
+
+# ---------------- Worker Processes ----------------
+QUEUED_DOCKER_OPS = ("run_container", "run_sidecar", "exec", "stop", "start", "restart", "remove", "update", "rename", "stop_many", "start_many", "remove_many")
+
+class JobQueue:
+    """Docker calls queued in SQLite for worker processes (`python bot.py --worker`) to run.
+
+    Any number of workers claim from the same file. The bot polls once per JOB_POLL_INTERVAL
+    for all of its outstanding calls and resolves their futures, so waiting costs one query
+    per tick rather than one per call.
+
+    Jobs carry the session (bot PID) that queued them. Opening the queue as the bot drops every
+    job left by an earlier process and makes its own session current; workers only claim jobs
+    of the current session while that process is alive, so a dead bot's calls never run.
+    """
+
+    def __init__(self, path, session=None):
+        self.conn = open_sqlite(path)
+        self.conn.execute("PRAGMA busy_timeout = 5000")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, node TEXT, op TEXT, args TEXT, "
+            "status TEXT NOT NULL DEFAULT 'queued', result TEXT, created_at REAL, claimed_at REAL, session TEXT)"
+        )
+        if "session" not in [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN session TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.session = session
+        self.waiters = {}  # job id -> future (bot side)
+        self.poll_task = None
+        if session is not None:
+            with self.conn:
+                # Nothing in this new process waits on older jobs; running them now would act on stale intent
+                stale = self.conn.execute("DELETE FROM jobs").rowcount
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('session', ?)", (session,))
+            if stale:
+                logger.warning(f"Dropped {stale} Docker job(s) left in {path} by a previous bot process")
+
+    async def call(self, node_name, op, *args):
+        """Run a backend op on a worker and return its result; worker-side errors are re-raised here"""
+        with self.conn:
+            job_id = self.conn.execute(
+                "INSERT INTO jobs (node, op, args, created_at, session) VALUES (?, ?, ?, ?, ?)",
+                (node_name, op, json.dumps(args), datetime.utcnow().timestamp(), self.session)
+            ).lastrowid
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[job_id] = future
+        if self.poll_task is None or self.poll_task.done():
+            self.poll_task = asyncio.create_task(self.poll_results())
+        return await future
+
+    async def poll_results(self):
+        while self.waiters:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'failed', result = ? WHERE status IN ('queued', 'running') AND COALESCE(claimed_at, created_at) < ?",
+                    (json.dumps({"error": f"No worker finished the job within {JOB_LEASE_SECONDS}s"}), datetime.utcnow().timestamp() - JOB_LEASE_SECONDS)
+                )
+                rows = self.conn.execute("SELECT id, status, result FROM jobs WHERE status IN ('done', 'failed')").fetchall()
+                self.conn.executemany("DELETE FROM jobs WHERE id = ?", [(row[0],) for row in rows])
+            for job_id, status, result in rows:
+                future = self.waiters.pop(job_id, None)
+                if not future or future.done():
+                    continue
+                result = json.loads(result)
+                if status == 'done':
+                    future.set_result(result)
+                elif result.get('timeout'):
+                    future.set_exception(asyncio.TimeoutError())
+                else:
+                    future.set_exception(RuntimeError(result['error']))
+
+    def current_session(self):
+        """Session whose jobs may run: the bot that last opened the queue, if that process is still alive"""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'session'").fetchone()
+        if not row:
+            return None
+        try:
+            os.kill(int(row[0]), 0)
+        except ProcessLookupError:
+            return None
+        except PermissionError:
+            pass
+        return row[0]
+
+    def claim(self, limit):
+        """Mark up to `limit` queued jobs of the current session as running and return them (worker side)"""
+        session = self.current_session()
+        if session is None:
+            return []
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.conn.execute(
+                "SELECT id, node, op, args FROM jobs WHERE status = 'queued' AND session = ? ORDER BY id LIMIT ?", (session, limit)
+            ).fetchall()
+            now = datetime.utcnow().timestamp()
+            self.conn.executemany("UPDATE jobs SET status = 'running', claimed_at = ? WHERE id = ?", [(now, row[0]) for row in rows])
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        return rows
+
+    def finish(self, job_id, ok, result):
+        with self.conn:
+            self.conn.execute("UPDATE jobs SET status = ?, result = ? WHERE id = ?", ('done' if ok else 'failed', json.dumps(result), job_id))
+
+class QueuedDockerBackend(DockerBackend):
+    """Sends the slow Docker calls (run, exec, lifecycle) to worker processes; reads stay in-process"""
+
+    def __init__(self, inner, queue, node_name):
+        self.inner = inner
+        self.queue = queue
+        self.node_name = node_name
+        self.name = f"{inner.name} via workers"
+
+    async def run_container(self, name, image, ram_gb, cpu, ports, disk_gb=None):
+        # JSON object keys are strings, so ports travel as pairs
+        container_id, err = await self.queue.call(self.node_name, "run_container", name, image, ram_gb, cpu, list(ports.items()), disk_gb)
+        return container_id, err
+
+    async def run_sidecar(self, name, image, cmd):
+        container_id, err = await self.queue.call(self.node_name, "run_sidecar", name, image, cmd)
+        return container_id, err
+
+    async def exec(self, container_id, cmd, timeout=None):
+        rc, out = await self.queue.call(self.node_name, "exec", container_id, cmd, timeout)
+        return rc, out
+
+    async def stop(self, container_id): return await self.queue.call(self.node_name, "stop", container_id)
+    async def start(self, container_id): return await self.queue.call(self.node_name, "start", container_id)
+    async def restart(self, container_id): return await self.queue.call(self.node_name, "restart", container_id)
+    async def remove(self, container_id): return await self.queue.call(self.node_name, "remove", container_id)
+    async def update(self, container_id, ram_gb, cpu): return await self.queue.call(self.node_name, "update", container_id, ram_gb, cpu)
+    async def rename(self, container_id, name): return await self.queue.call(self.node_name, "rename", container_id, name)
+    async def stop_many(self, container_ids): return await self.queue.call(self.node_name, "stop_many", container_ids)
+    async def start_many(self, container_ids): return await self.queue.call(self.node_name, "start_many", container_ids)
+    async def remove_many(self, container_ids): return await self.queue.call(self.node_name, "remove_many", container_ids)
+
+    async def inspect(self, container_id): return await self.inner.inspect(container_id)
+    async def list_containers(self, name_prefix=""): return await self.inner.list_containers(name_prefix)
+    async def image_exists(self, tag): return await self.inner.image_exists(tag)
+    async def build_image(self, tag, dockerfile): return await self.inner.build_image(tag, dockerfile)
+    async def info(self): return await self.inner.info()
+    async def ping(self): return await self.inner.ping()
+    async def close(self): await self.inner.close()
+
+    async def stream_stats(self):
+        async for stat in self.inner.stream_stats():
+            yield stat
+
+job_queue = None  # Set in the bot process when JOB_WORKERS > 0; workers open their own
+
+def enable_job_queue():
+    global job_queue
+    job_queue = JobQueue(JOB_DB_FILE, session=str(os.getpid()))
+
+async def supervise_workers(count=JOB_WORKERS):
+    """Keep `count` worker processes running; they exit on their own once this process is gone"""
+    procs = {}
+    while True:
+        for i in range(count):
+            proc = procs.get(i)
+            if proc is None or proc.returncode is not None:
+                if proc:
+                    logger.warning(f"Worker {i} exited with code {proc.returncode}, restarting")
+                procs[i] = await asyncio.create_subprocess_exec(
+                    sys.executable, os.path.abspath(__file__), "--worker",
+                    env={**os.environ, "BOT_PARENT_PID": str(os.getpid())}
+                )
+        await asyncio.sleep(5)
+
+async def run_job(queue, job_id, node_name, op, args):
+    try:
+        if op not in QUEUED_DOCKER_OPS or node_name not in nodes:
+            raise ValueError(f"Bad job {op} on {node_name}")
+        backend = nodes[node_name].backend
+        if isinstance(backend, QueuedDockerBackend):
+            # Worker loop running inside the bot process
+            backend = backend.inner
+        if op == "run_container":
+            args[4] = dict(args[4])
+        queue.finish(job_id, True, await getattr(backend, op)(*args))
+    except asyncio.TimeoutError:
+        queue.finish(job_id, False, {"error": "timeout", "timeout": True})
+    except Exception as e:
+        queue.finish(job_id, False, {"error": f"{type(e).__name__}: {e}"})
+
+async def run_worker(queue=None, concurrency=WORKER_CONCURRENCY):
+    """Worker process main loop: claim queued Docker calls and run them on the node's backend"""
+    queue = queue or JobQueue(JOB_DB_FILE)
+    parent = int(os.environ.get("BOT_PARENT_PID", 0))
+    for node in nodes.values():
+        await connect_node(node)
+    running = set()
+    logger.info(f"Worker {os.getpid()} ready ({concurrency} concurrent jobs)")
+    while not parent or os.getppid() == parent:
+        rows = queue.claim(concurrency - len(running)) if len(running) < concurrency else []
+        for job_id, node_name, op, args in rows:
+            task = asyncio.create_task(run_job(queue, job_id, node_name, op, json.loads(args)))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        if not rows:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+    logger.info(f"Bot process {parent} is gone, worker {os.getpid()} exiting")
+
+# ---------------- Docker Helpers ----------------
+
+def dockerfile_version():
+    """Short content hash of DockerFile, used as the baked image tag"""
+    with open(DOCKERFILE_PATH, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+async def ensure_vps_image(node):
+    """Build the versioned VPS image from DockerFile once per node and reuse it for every deploy there"""
+    try:
+        tag = f"{VPS_IMAGE_NAME}:{dockerfile_version()}"
+        if not await node.backend.image_exists(tag):
+            logger.info(f"Building VPS image {tag} on {node.name}")
+            with open(DOCKERFILE_PATH, 'rb') as f:
+                ok, err = await node.backend.build_image(tag, f.read())
+            if not ok:
+                logger.error(f"VPS image build failed on {node.name}, using {IMAGE}: {err}")
+                return False
+        node.image = tag
+        logger.info(f"Using baked VPS image {tag} on {node.name}")
+        return True
+    except Exception as e:
+        logger.error(f"VPS image check failed on {node.name}, using {IMAGE}: {e}")
+        return False
+
+@instrumented(docker_latency, "wait_for_container_ready")
+async def wait_for_container_ready(container_id, timeout=READY_TIMEOUT):
+    """Poll systemd inside the container until boot has finished instead of sleeping a fixed time"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    delay = 0.25
+    while loop.time() < deadline:
+        try:
+            _, out = await node_for(container_id).backend.exec(container_id, ["systemctl", "is-system-running"], timeout=10)
+            # "offline" means systemd isn't PID 1, so there is nothing more to wait for
+            if out.strip() in ("running", "degraded", "offline"):
+                return True
+        except Exception as e:
+            logger.debug(f"Readiness probe failed for {container_id}: {e}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 2)
+    return False
+
+def disk_quota_enabled(node):
+    return ENFORCE_DISK_QUOTA and node.disk_quota_supported is not False
+
+needs_bootstrap = set()  # Containers started from IMAGE (no baked image yet) awaiting the apt setup
+
+@instrumented(docker_latency, "docker_run_container")
+async def docker_run_container(ram_gb, cpu, disk_gb, name_prefix="vps", node=None):
+    node = node or nodes[DEFAULT_NODE]
+    # Retry with fresh slots if something outside our bookkeeping already holds the port or name
+    for attempt in range(3):
+        http_port = node.http_ports.allocate()
+        number = name_numbers.allocate()
+        if http_port is None or number is None:
+            return None, None, f"No free ports or container names left on {node.name}"
+        name = f"{name_prefix}-{number}"
+        
+        try:
+            # Uses systemd-enabled image that has /sbin/init
+            quota = disk_gb if disk_quota_enabled(node) else None
+            image = node.image or IMAGE
+            container_id, err = await node.backend.run_container(name, image, ram_gb, cpu, {80: http_port}, quota)
+            if err and quota and "storage-opt" in err:
+                # e.g. overlay2 not on xfs with pquota: remember and deploy without a disk cap
+                logger.warning(f"Storage driver on {node.name} can't enforce disk quotas, disabling them: {err}")
+                node.disk_quota_supported = False
+                container_id, err = await node.backend.run_container(name, image, ram_gb, cpu, {80: http_port})
+        except Exception as e:
+            container_id, err = None, f"Container run exception: {str(e)}"
+        
+        if err and ("port is already allocated" in err or "address already in use" in err):
+            # Leave the port reserved; it's taken outside our bookkeeping
+            name_numbers.release(number)
+            continue
+        if err and "is already in use" in err:
+            node.http_ports.release(http_port)
+            continue
+        if err or not container_id:
+            node.http_ports.release(http_port)
+            name_numbers.release(number)
+            return None, None, err or "Failed to get container ID"
+        
+        claim_slots(node, container_id, number, [http_port])
+        if image == IMAGE:
+            needs_bootstrap.add(container_id)
+        return container_id, http_port, None
+    return None, None, "Container creation failed: port/name conflicts on every attempt"
+
+@instrumented(docker_latency, "setup_vps_environment")
+async def setup_vps_environment(container_id):
+    try:
+        # Wait for systemd to finish booting
+        if not await wait_for_container_ready(container_id):
+            logger.warning(f"Container {container_id} not ready after {READY_TIMEOUT}s")
+        
+        # The baked image already ships the essentials and enables systemd-user-sessions
+        if container_id not in needs_bootstrap:
+            return True, None
+        node = node_for(container_id)
+        
+        # Update and install essentials
+        commands = [
+            "apt-get update -y",
+            "apt-get install -y tmate curl wget neofetch sudo nano htop",
+            "systemctl enable systemd-user-sessions",
+            "systemctl start systemd-user-sessions"
+        ]
+        
+        for cmd in commands:
+            try:
+                await node.backend.exec(container_id, ["bash", "-c", cmd], timeout=120)
+            except asyncio.TimeoutError:
+                logger.warning(f"Timeout on command: {cmd}")
+                continue
+            except Exception as e:
+                logger.warning(f"Command failed {cmd}: {e}")
+                continue
+        
+        return True, None
+    except Exception as e:
+        return False, str(e)
+    finally:
+        needs_bootstrap.discard(container_id)
+
+@instrumented(docker_latency, "docker_exec_capture_ssh")
+async def docker_exec_capture_ssh(container_id):
+    """SSH string of the container's tmate session, reusing the live one when there is one"""
+    try:
+        return await tmate_sessions.get(container_id)
+    except Exception as e:
+        return "ssh@tmate.io", str(e)
+
+@instrumented(docker_latency, "docker_stop_container")
+async def docker_stop_container(container_id):
+    return await node_for(container_id).backend.stop(container_id)
+
+@instrumented(docker_latency, "docker_start_container")
+async def docker_start_container(container_id):
+    return await node_for(container_id).backend.start(container_id)
+
+@instrumented(docker_latency, "docker_restart_container")
+async def docker_restart_container(container_id):
+    return await node_for(container_id).backend.restart(container_id)
+
+@instrumented(docker_latency, "docker_remove_container")
+async def docker_remove_container(container_id):
+    removed = await node_for(container_id).backend.remove(container_id)
+    # Free the name and ports even if it was already gone
+    await forget_container(container_id)
+    return removed
+
+async def forget_container(container_id):
+    """Drop what's kept about a removed container: port forwards, name/port slots and tmate session"""
+    await port_forwarder.close_container(container_id)
+    release_slots(container_id)
+    tmate_sessions.forget(container_id)
+
+@instrumented(docker_latency, "docker_update_limits")
+async def docker_update_limits(container_id, ram_gb, cpu):
+    return await node_for(container_id).backend.update(container_id, ram_gb, cpu)
+
+@instrumented(docker_latency, "docker_rename_container")
+async def docker_rename_container(container_id, name):
+    return await node_for(container_id).backend.rename(container_id, name)
+
+@instrumented(docker_latency, "add_port_to_container")
+async def add_port_to_container(container_id, port):
+    """Forward a free host port to `port` inside the container and record it in the VPS's port_map"""
+    try:
+        node = node_for(container_id)
+        
+        # Get container details to check if it exists
+        if not await node.backend.inspect(container_id):
+            return False, "Container not found"
+        if not await port_forwarder.container_ip(container_id):
+            return False, "Container isn't running"
+        
+        rec = vps_db.get(container_id, {})
+        host_port = rec.get('port_map', {}).get(str(port))
+        for attempt in range(3):
+            if host_port is None:
+                host_port = forward_ports.allocate()
+                if host_port is None:
+                    return False, "No free host ports left"
+            ok, err = await port_forwarder.open(host_port, container_id, port)
+            if ok:
+                break
+            # In use by something else on the node: keep it reserved and try another
+            host_port = None
+        else:
+            return False, f"Could not bind a host port: {err}"
+        
+        claim_slots(node, container_id, ports=[host_port])
+        if rec and rec.setdefault('port_map', {}).get(str(port)) != host_port:
+            rec['port_map'][str(port)] = host_port
+            try:
+                persist_vps(container_id)
+            except Exception:
+                # An unrecorded forward would never be closed again
+                del rec['port_map'][str(port)]
+                await port_forwarder.close(node, [host_port])
+                raise
+        return True, f"Port {port} mapped to {node.public_ip}:{host_port}"
+    except Exception as e:
+        return False, str(e)
+
+@instrumented(docker_latency, "check_systemctl_status")
+async def check_systemctl_status(container_id):
+    """Check if systemctl works in the container"""
+    try:
+        returncode, _ = await node_for(container_id).backend.exec(container_id, ["systemctl", "--version"])
+        return returncode == 0
+    except:
+        return False
+
+# ---------------- SSH Sessions ----------------
+class TmateSessionManager:
+    """Caches each container's tmate SSH string and only starts a new session when the old one is gone.
+
+    `tmate has-session` is the liveness probe, so asking for SSH doesn't disconnect whoever is
+    already attached. New sessions wait on tmate's own tmate-ready event rather than a fixed sleep.
+    """
+
+    def __init__(self):
+        self.ssh = {}  # container_id -> SSH string of the live session
+        self.locks = {}  # container_id -> lock so concurrent callers share one new session
+        self.task = None
+
+    @staticmethod
+    def socket(container_id):
+        return f"/tmp/tmate-{container_id}.sock"
+
+    async def alive(self, container_id):
+        rc, _ = await node_for(container_id).backend.exec(container_id, ["tmate", "-S", self.socket(container_id), "has-session"], timeout=10)
+        return rc == 0
+
+    async def create(self, container_id):
+        """Start a session and return (ssh, error)"""
+        sock = self.socket(container_id)
+        # A dead server can leave its socket behind, which would make new-session attach to nothing
+        ssh_cmd = (f"rm -f {sock} && tmate -S {sock} new-session -d && tmate -S {sock} wait tmate-ready"
+                   f" && tmate -S {sock} display -p '#{{tmate_ssh}}'")
+        try:
+            rc, stdout = await node_for(container_id).backend.exec(container_id, ["bash", "-c", ssh_cmd], timeout=TMATE_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None, f"tmate not ready after {TMATE_READY_TIMEOUT}s"
+        ssh = stdout.strip()
+        if rc != 0 or not ssh:
+            return None, f"tmate failed (exit {rc})"
+        return ssh, None
+
+    async def get(self, container_id):
+        """Returns (ssh, error); the cached string when its session is still up, otherwise a new one"""
+        async with self.locks.setdefault(container_id, asyncio.Lock()):
+            cached = self.ssh.get(container_id) or vps_db.get(container_id, {}).get('ssh')
+            if cached and cached != "ssh@tmate.io" and await self.alive(container_id):
+                self.ssh[container_id] = cached
+                return cached, None
+            ssh, err = await self.create(container_id)
+            if err:
+                self.ssh.pop(container_id, None)
+                return "ssh@tmate.io", err
+            self.ssh[container_id] = ssh
+            return ssh, None
+
+    def forget(self, container_id):
+        self.ssh.pop(container_id, None)
+        self.locks.pop(container_id, None)
+
+    async def refresh_all(self):
+        """Revive dead sessions of every running VPS and save the SSH strings that changed"""
+        semaphore = asyncio.Semaphore(SSH_REFRESH_CONCURRENCY)
+        changed = []
+
+        async def refresh(cid):
+            async with semaphore:
+                ssh, err = await docker_exec_capture_ssh(cid)
+            rec = vps_db.get(cid)
+            if err:
+                logger.warning(f"SSH refresh failed for {cid}: {err}")
+            elif rec and rec.get('ssh') != ssh:
+                rec['ssh'] = ssh
+                changed.append(cid)
+
+        await asyncio.gather(*(
+            refresh(cid) for cid, rec in list(vps_db.items())
+            if rec.get('active', True) and not rec.get('suspended') and node_for(cid).healthy
+        ))
+        if changed:
+            persist_vps(*changed)
+            logger.info(f"Regenerated {len(changed)} dead tmate session(s)")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(SSH_REFRESH_INTERVAL)
+            try:
+                await self.refresh_all()
+            except Exception as e:
+                logger.error(f"SSH refresh failed: {e}")
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+tmate_sessions = TmateSessionManager()
+
+# ---------------- Warm Pool ----------------
+warm_pool = []  # (container_id, http_port) of idle containers that have finished booting, on any node
+warm_pool_stats = {"hits": 0, "misses": 0}
+warm_pool_task = None
+
+def get_warm_pool_stats():
+    """Warm pool size and hit/miss counters"""
+    claims = warm_pool_stats["hits"] + warm_pool_stats["misses"]
+    return {
+        'idle': len(warm_pool),
+        'hits': warm_pool_stats["hits"],
+        'misses': warm_pool_stats["misses"],
+        'hit_rate': (warm_pool_stats["hits"] / claims * 100) if claims else 0.0
+    }
+
+def warm_pool_on(node):
+    return [entry for entry in warm_pool if node_for(entry[0]) is node]
+
+async def adopt_warm_pool(node, containers):
+    """Re-adopt idle pool containers left behind on a node by a previous bot process"""
+    try:
+        adopted = 0
+        for c in containers:
+            if not c["name"].startswith("vps-pool-"):
+                continue
+            if c["state"] == "running" and 80 in c["ports"] and not node.draining:
+                warm_pool.append((c["id"], c["ports"][80]))
+                adopted += 1
+            else:
+                await docker_remove_container(c["id"])
+        if adopted:
+            logger.info(f"Adopted {adopted} warm pool container(s) on {node.name}")
+    except Exception as e:
+        logger.warning(f"Failed to adopt warm pool on {node.name}: {e}")
+
+async def refill_warm_pool():
+    """Boot containers until every placeable node's pool is back at WARM_POOL_SIZE"""
+    for node in placeable_nodes():
+        if node.image_task and not node.image_task.done():
+            # Refilled from the baked image once the build finishes
+            continue
+        while len(warm_pool_on(node)) < WARM_POOL_SIZE and not node.draining:
+            reason = admission.check(DEFAULT_RAM_GB, DEFAULT_CPU, DEFAULT_DISK_GB, node)
+            if reason:
+                logger.info(f"Warm pool on {node.name} not refilled: {reason}")
+                break
+            cid, http_port, err = await docker_run_container(DEFAULT_RAM_GB, DEFAULT_CPU, DEFAULT_DISK_GB, name_prefix="vps-pool", node=node)
+            if err:
+                logger.warning(f"Warm pool refill on {node.name} failed: {err}")
+                break
+            success, setup_err = await setup_vps_environment(cid)
+            if not success:
+                logger.warning(f"Warm pool setup failed for {cid}: {setup_err}")
+                await docker_remove_container(cid)
+                break
+            # Start its tmate session now so a claim hands out SSH without waiting for tmate
+            await docker_exec_capture_ssh(cid)
+            warm_pool.append((cid, http_port))
+
+def schedule_warm_pool_refill():
+    global warm_pool_task
+    if WARM_POOL_SIZE and (warm_pool_task is None or warm_pool_task.done()):
+        warm_pool_task = asyncio.create_task(refill_warm_pool())
+
+async def claim_warm_container(ram_gb, cpu, disk_gb, node):
+    """Take a booted container on `node` from the pool and apply the owner's limits; None on a miss"""
+    claimed = None
+    # A disk quota is fixed at creation, so pool containers only fit the default disk size
+    while not claimed and (disk_gb == DEFAULT_DISK_GB or not disk_quota_enabled(node)):
+        idle = warm_pool_on(node)
+        if not idle:
+            break
+        cid, http_port = idle[0]
+        warm_pool.remove(idle[0])
+        # CPU/RAM limits are applied on claim, so one pool serves every plan size; the name keeps its number
+        number = container_slots.get(cid, {}).get("name")
+        if number is not None and await docker_update_limits(cid, ram_gb, cpu) and await docker_rename_container(cid, f"vps-{number}"):
+            claimed = (cid, http_port)
+        else:
+            await docker_remove_container(cid)
+    warm_pool_stats["hits" if claimed else "misses"] += 1
+    stats = get_warm_pool_stats()
+    logger.info(f"Warm pool {'hit' if claimed else 'miss'} (hit rate {stats['hit_rate']:.0f}%, {stats['idle']} idle)")
+    schedule_warm_pool_refill()
+    return claimed
+
+async def prepare_docker_host():
+    """Startup work that must finish before the warm pool is filled"""
+    with timed("connect nodes"):
+        listings = await asyncio.gather(*(prepare_node(node) for node in nodes.values()))
+    with timed("reconcile"):
+        await lifecycle.reconcile({node.name: listing for node, listing in zip(nodes.values(), listings)})
+    with timed("port forwards"):
+        await restore_port_forwards()
+    schedule_warm_pool_refill()
+    log_startup_report("Docker ready")
+
+# ---------------- Telemetry ----------------
+class ResourceTelemetry:
+    """Per-container usage history in fixed-size ring buffers, fed by one stats stream"""
+
+    def __init__(self, history=TELEMETRY_HISTORY):
+        self.history = history
+        self.samples = {}  # container_id -> deque of (timestamp, cpu_percent, mem_bytes, mem_limit)
+
+    def record(self, stat, now=None):
+        now = now or datetime.utcnow().timestamp()
+        ring = self.samples.get(stat["id"])
+        if ring is None:
+            ring = self.samples[stat["id"]] = deque(maxlen=self.history)
+        # docker stats refreshes every ~2s; keep one sample per TELEMETRY_INTERVAL
+        if ring and now - ring[-1][0] < TELEMETRY_INTERVAL:
+            ring[-1] = (ring[-1][0], stat["cpu_percent"], stat["mem_bytes"], stat["mem_limit"])
+        else:
+            ring.append((now, stat["cpu_percent"], stat["mem_bytes"], stat["mem_limit"]))
+
+    def latest(self, container_id):
+        ring = self.samples.get(container_id)
+        return ring[-1] if ring else None
+
+    def prune(self, now=None):
+        """Forget containers that stopped reporting (stopped or removed)"""
+        cutoff = (now or datetime.utcnow().timestamp()) - TELEMETRY_INTERVAL * 6
+        for cid in [cid for cid, ring in self.samples.items() if ring[-1][0] < cutoff]:
+            del self.samples[cid]
+
+    def totals(self):
+        """CPU cores and RAM bytes currently used by all reporting containers"""
+        self.prune()
+        latest = [ring[-1] for ring in self.samples.values()]
+        return sum(s[1] for s in latest) / 100, sum(s[2] for s in latest)
+
+telemetry = ResourceTelemetry()
+
+def host_capacity():
+    """CPU, RAM and Docker disk of this machine as read from the OS"""
+    meminfo = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                meminfo[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    disk = shutil.disk_usage(DOCKER_DATA_ROOT if os.path.exists(DOCKER_DATA_ROOT) else "/")
+    return {
+        'cpus': os.cpu_count() or 1,
+        'ram_gb': meminfo.get("MemTotal", 0) / 1024 ** 3,
+        'ram_available_gb': meminfo["MemAvailable"] / 1024 ** 3 if "MemAvailable" in meminfo else None,
+        'disk_gb': disk.total / 1024 ** 3,
+        'disk_used_gb': disk.used / 1024 ** 3
+    }
+
+async def telemetry_collector(node):
+    """Feed the ring buffers from a node's stats stream, restarting it if it drops"""
+    while True:
+        try:
+            if node.healthy:
+                async for stat in node.backend.stream_stats():
+                    telemetry.record(stat)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Stats stream from {node.name} failed: {e}")
+        await asyncio.sleep(TELEMETRY_INTERVAL)
+
+# ---------------- Admission Control ----------------
+class AdmissionController:
+    """Places deploys on the least-loaded node whose allocated CPU/RAM/disk stays within its capacity times the overcommit ratios.
+
+    Allocation is what vps_db records on that node ask for (CPU/RAM for running VPSes, disk for
+    all of them) plus reservations for deploys still in flight. A deploy that fits no node waits
+    for capacity to be released, up to a timeout; one that could never fit is rejected straight away.
+    """
+
+    def __init__(self):
+        self.reservations = {}  # token -> (node name, ram_gb, cpu, disk_gb)
+        self.next_token = 0
+        self.waiting = 0  # Deploys currently queued for capacity
+        self.changed = asyncio.Event()
+
+    def allocated(self, node):
+        ram = cpu = disk = 0
+        for rec in vps_db.values():
+            if rec.get('node', DEFAULT_NODE) != node.name:
+                continue
+            disk += rec.get('disk', 0)
+            if rec.get('active', True) and not rec.get('suspended'):
+                ram += rec.get('ram', 0)
+                cpu += rec.get('cpu', 0)
+        for r_node, r_ram, r_cpu, r_disk in self.reservations.values():
+            if r_node == node.name:
+                ram, cpu, disk = ram + r_ram, cpu + r_cpu, disk + r_disk
+        return {'ram': ram, 'cpu': cpu, 'disk': disk}
+
+    def limits(self, host):
+        return {
+            'ram': host['ram_gb'] * RAM_OVERCOMMIT,
+            'cpu': host['cpus'] * CPU_OVERCOMMIT,
+            # Remote daemons don't report disk size
+            'disk': host['disk_gb'] * DISK_OVERCOMMIT if host['disk_gb'] is not None else float('inf')
+        }
+
+    def check(self, ram_gb, cpu, disk_gb, node, host=None):
+        """None if the deploy fits on the node right now, otherwise the reason it doesn't"""
+        host = host or node.capacity()
+        limits = self.limits(host)
+        allocated = self.allocated(node)
+        for key, want, unit in (('ram', ram_gb, "GB RAM"), ('cpu', cpu, " CPU"), ('disk', disk_gb, "GB disk")):
+            if allocated[key] + want > limits[key]:
+                return f"Not enough capacity on {node.name}: {allocated[key]:g}/{limits[key]:g}{unit} allocated, {want:g}{unit} requested"
+        if host['ram_available_gb'] is not None and host['ram_available_gb'] < MIN_FREE_RAM_GB:
+            return f"{node.name} is low on memory: {host['ram_available_gb']:.1f}GB free"
+        return None
+
+    def place(self, ram_gb, cpu, disk_gb):
+        """(node, None) for the least-loaded node the deploy fits on, or (None, reason)"""
+        best, best_load, reason = None, None, "No healthy nodes accepting VPSes"
+        for node in placeable_nodes():
+            host = node.capacity()
+            node_reason = self.check(ram_gb, cpu, disk_gb, node, host)
+            if node_reason:
+                reason = node_reason
+                continue
+            limits = self.limits(host)
+            allocated = self.allocated(node)
+            # Load after placing: the fuller of CPU and RAM relative to the node's limit
+            load = max((allocated['ram'] + ram_gb) / limits['ram'], (allocated['cpu'] + cpu) / limits['cpu'])
+            if best is None or load < best_load:
+                best, best_load = node, load
+        return (best, None) if best else (None, reason)
+
+    async def admit(self, ram_gb, cpu, disk_gb, timeout=ADMISSION_QUEUE_TIMEOUT):
+        """Reserve capacity on a node. Returns (token, node, None) or (None, None, reason); timeout=None waits indefinitely"""
+        candidates = [node for node in nodes.values() if not node.draining]
+        for key, want, unit in (('ram', ram_gb, "GB RAM"), ('cpu', cpu, " CPU"), ('disk', disk_gb, "GB disk")):
+            # Nodes that haven't reported capacity yet might still fit it
+            if candidates and all(node.info or node.is_local for node in candidates) and \
+                    all(want > self.limits(node.capacity())[key] for node in candidates):
+                return None, None, f"Requested {want:g}{unit} exceeds the limit of every node"
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        queued = False
+        try:
+            while True:
+                changed = self.changed
+                node, reason = self.place(ram_gb, cpu, disk_gb)
+                if node:
+                    self.next_token += 1
+                    self.reservations[self.next_token] = (node.name, ram_gb, cpu, disk_gb)
+                    return self.next_token, node, None
+                remaining = None if deadline is None else deadline - loop.time()
+                if remaining is not None and remaining <= 0:
+                    return None, None, f"{reason} (waited {timeout}s)"
+                if not queued:
+                    queued = True
+                    self.waiting += 1
+                logger.info(f"Deploy queued: {reason}")
+                # Re-check on release or every 30s, since free memory can change without a release
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=30 if remaining is None else min(remaining, 30))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if queued:
+                self.waiting -= 1
+
+    def release(self, token):
+        self.reservations.pop(token, None)
+        self.notify()
+
+    def notify(self):
+        """Wake queued deploys to re-check capacity"""
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+admission = AdmissionController()
+
+# ---------------- Activity Log ----------------
+class JsonlLogSink:
+    """Append-only JSONL activity log, rotated by size; rotated files are pruned by count and age"""
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, retention_days=LOG_RETENTION_DAYS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.retention_days = retention_days
+
+    def rotated_files(self):
+        """Rotated log paths, newest first"""
+        directory, base = os.path.split(self.path)
+        names = [n for n in os.listdir(directory or ".") if n.startswith(base + ".")]
+        return sorted((os.path.join(directory, n) for n in names), reverse=True)
+
+    def write(self, entries):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            size = f.tell()
+        if size >= self.max_bytes:
+            os.replace(self.path, f"{self.path}.{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}")
+            self.prune()
+
+    def prune(self):
+        cutoff = datetime.utcnow().timestamp() - self.retention_days * 86400
+        for i, path in enumerate(self.rotated_files()):
+            if i >= self.backups or os.path.getmtime(path) < cutoff:
+                os.remove(path)
+
+    def import_legacy(self, legacy_path):
+        """Move the entries of the old vps_logs.json list in as the oldest rotated file, once"""
+        if not os.path.exists(legacy_path):
+            return
+        entries = load_json(legacy_path, [])
+        if entries:
+            # Sorts after every timestamped rotation, i.e. read last and pruned as the oldest
+            path = f"{self.path}.{'0' * 20}"
+            with open(path, 'w', encoding='utf-8') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            try:
+                last = datetime.fromisoformat(entries[-1]["timestamp"]).timestamp()
+                os.utime(path, (last, last))
+            except (KeyError, TypeError, ValueError):
+                pass
+        if os.path.exists(legacy_path):  # a corrupt file was already moved aside by load_json
+            os.replace(legacy_path, legacy_path + ".imported")
+        logger.info(f"Imported {len(entries)} activity log entries from {legacy_path}")
+
+    def read_recent(self, limit=100):
+        """Last `limit` entries, oldest first"""
+        lines = []
+        for path in [self.path] + self.rotated_files():
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.readlines() + lines
+            if len(lines) >= limit:
+                break
+        entries = []
+        for line in lines[-limit:]:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        return entries
+
+log_sink = JsonlLogSink(os.path.join(DATA_DIR, "vps_logs.jsonl"))
+with timed("load data"):
+    log_sink.import_legacy(os.path.join(DATA_DIR, "vps_logs.json"))
+log_queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+
+def build_log_embed(action, user, details, vps_id):
+    # Determine color based on action type
+    color_map = {
+        "deploy": discord.Color.green(),
+        "remove": discord.Color.orange(),
+        "renew": discord.Color.blue(),
+        "suspend": discord.Color.red(),
+        "unsuspend": discord.Color.green(),
+        "start": discord.Color.green(),
+        "stop": discord.Color.orange(),
+        "restart": discord.Color.blue(),
+        "share": discord.Color.purple(),
+        "admin": discord.Color.gold(),
+        "points": discord.Color.teal(),
+        "invite": discord.Color.magenta(),
+        "error": discord.Color.red()
+    }
     
-    for giveaway_id, giveaway in list(giveaways.items()):
-        if giveaway['status'] == 'active' and now >= datetime.fromisoformat(giveaway['end_time']):
-            # Giveaway ended, select winner
-            participants = giveaway.get('participants', [])
-            if participants:
-                if giveaway['winner_type'] == 'random':
-                    winner_id = random.choice(participants)
-                    giveaway['winner_id'] = winner_id
-                    giveaway['status'] = 'ended'
-                    
-                    # Create VPS for winner
-                    try:
-                        rec = await create_vps(int(winner_id), giveaway['vps_ram'], giveaway['vps_cpu'], giveaway['vps_disk'], giveaway_vps=True)
-                        if 'error' not in rec:
-                            giveaway['vps_created'] = True
-                            giveaway['winner_vps_id'] = rec['container_id']
-                            
-                            # Send DM to winner
-                            try:
-                                winner = await bot.fetch_user(int(winner_id))
-                                embed = discord.Embed(title="🎉 You Won a VPS Giveaway!", color=discord.Color.gold())
-                                embed.add_field(name="Container ID", value=f"`{rec['container_id']}`", inline=False)
-                                embed.add_field(name="Specs", value=f"**{rec['ram']}GB RAM** | **{rec['cpu']} CPU** | **{rec['disk']}GB Disk**", inline=False)
-                                embed.add_field(name="Expires", value=rec['expires_at'][:10], inline=True)
-                                embed.add_field(name="Status", value="🟢 Active", inline=True)
-                                embed.add_field(name="HTTP Access", value=f"http://{SERVER_IP}:{rec['http_port']}", inline=False)
-                                embed.add_field(name="SSH Connection", value=f"```{rec['ssh']}```", inline=False)
-                                embed.set_footer(text="This is a giveaway VPS and cannot be renewed. It will auto-delete after 15 days.")
-                                await winner.send(embed=embed)
-                            except:
-                                pass
-                    except Exception as e:
-                        logger.error(f"Failed to create VPS for giveaway winner: {e}")
-                
-                elif giveaway['winner_type'] == 'all':
-                    # Create VPS for all participants
-                    successful_creations = 0
-                    for participant_id in participants:
-                        try:
-                            rec = await create_vps(int(participant_id), giveaway['vps_ram'], giveaway['vps_cpu'], giveaway['vps_disk'], giveaway_vps=True)
-                            if 'error' not in rec:
-                                successful_creations += 1
-                                
-                                # Send DM to participant
-                                try:
-                                    participant = await bot.fetch_user(int(participant_id))
-                                    embed = discord.Embed(title="🎉 You Received a VPS from Giveaway!", color=discord.Color.gold())
-                                 embed.add_field(name="Container ID", value=f"`{rec['container_id']}`", inline=False)
-                                    embed.add_field(name="Specs", value=f"**{rec['ram']}GB RAM** | **{rec['cpu']} CPU** | **{rec['disk']}GB Disk**", inline=False)
-                                    embed.add_field(name="Expires", value=rec['expires_at'][:10], inline=True)
-                                    embed.add_field(name="Status", value="🟢 Active", inline=True)
-                                    embed.add_field(name="HTTP Access", value=f"http://{SERVER_IP}:{rec['http_port']}", inline=False)
-                                    embed.add_field(name="SSH Connection
+    # Get appropriate color
+    action_lower = action.lower()
+    color = discord.Color.blue()  # default
+    for key, value in color_map.items():
+        if key in action_lower:
+            color = value
+            break
+    
+    # Create embed
+    embed = discord.Embed(
+        title=f"📊 {action}",
+        color=color,
+        timestamp=datetime.utcnow()
+    )
+    
+    # Add user info
+    if hasattr(user, 'mention'):
+        embed.add_field(name="👤 User", value=f"{user.mention}\n`{user.name}`", inline=True)
+    else:
+        embed.add_field(name="👤 User", value=f"`{user}`", inline=True)
+    
+    # Add VPS ID if provided
+    if vps_id:
+        embed.add_field(name="🆔 VPS ID", value=f"`{vps_id}`", inline=True)
+    
+    # Add details
+    if details:
+        embed.add_field(name="📝 Details", value=details[:1024], inline=False)
+    
+    # Add timestamp field
+    embed.add_field(
+        name="⏰ Time", 
+        value=f"<t:{int(datetime.utcnow().timestamp())}:R>", 
+        inline=True
+    )
+    
+    # Set footer
+    embed.set_footer(text="VPS Activity Log")
+    return embed
+
+async def send_log(action: str, user, details: str = "", vps_id: str = ""):
+    """Queue a log entry for the log channel and vps_logs.jsonl; never waits on either"""
+    entry = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "action": action,
+        "user": user.name if hasattr(user, 'name') else str(user),
+        "details": details,
+        "vps_id": vps_id
+    }
+    embed = build_log_embed(action, user, details, vps_id) if LOG_CHANNEL_ID else None
+    try:
+        log_queue.put_nowait((entry, embed))
+    except asyncio.QueueFull:
+        logger.warning(f"Log queue full, dropping log: {action}")
+
+def chunk_embeds(embeds):
+    """Split embeds into messages within Discord's 10 embeds / 6000 characters per message"""
+    chunk, size = [], 0
+    for embed in embeds:
+        if chunk and (len(chunk) == 10 or size + len(embed) > 6000):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(embed)
+        size += len(embed)
+    if chunk:
+        yield chunk
+
+async def post_log_embeds(embeds):
+    channel = bot.get_channel(LOG_CHANNEL_ID)
+    if not channel:
+        print(f"Log channel {LOG_CHANNEL_ID} not found")
+        return
+    for chunk in chunk_embeds(embeds):
+        await channel.send(embeds=chunk)
+
+async def log_consumer():
+    """Drain the log queue, coalescing whatever has piled up into one message and one file write"""
+    loop = asyncio.get_running_loop()
+    next_prune = loop.time()
+    while True:
+        if loop.time() >= next_prune:
+            # Rotation prunes too, but a quiet log may not rotate for longer than the retention period
+            await loop.run_in_executor(None, log_sink.prune)
+            next_prune = loop.time() + LOG_PRUNE_INTERVAL
+        try:
+            batch = [await asyncio.wait_for(log_queue.get(), next_prune - loop.time())]
+        except asyncio.TimeoutError:
+            continue
+        while len(batch) < LOG_BATCH_SIZE and not log_queue.empty():
+            batch.append(log_queue.get_nowait())
+        entries = [entry for entry, _ in batch]
+        embeds = [embed for _, embed in batch if embed]
+        results = await asyncio.gather(
+            loop.run_in_executor(None, log_sink.write, entries),
+            post_log_embeds(embeds) if embeds else asyncio.sleep(0),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Failed to send log: {result}")
+
+def read_recent_logs(limit=100):
+    """Latest activity log entries, oldest first (used by /logs)"""
+    return log_sink.read_recent(limit)
+
+# ---------------- Notifications ----------------
+user_cache = {}  # uid -> user from fetch_user, oldest first
+user_fetches = {}  # uid -> in-flight fetch_user task shared by concurrent lookups
+# Discord refused, or the request never got an answer
+NETWORK_ERRORS = (OSError, asyncio.TimeoutError) + ((aiohttp.ClientError,) if aiohttp else ())
+
+async def fetch_cached_user(user_id):
+    """User from the client cache, our cache or one fetch_user shared by concurrent lookups; fetch errors propagate"""
+    uid = int(user_id)
+    user = bot.get_user(uid) or user_cache.get(uid)
+    if user:
+        return user
+    task = user_fetches.get(uid)
+    if task is None:
+        task = user_fetches[uid] = asyncio.create_task(bot.fetch_user(uid))
+        task.add_done_callback(lambda _: user_fetches.pop(uid, None))
+    user = await asyncio.shield(task)
+    user_cache[uid] = user
+    if len(user_cache) > USER_CACHE_SIZE:
+        user_cache.pop(next(iter(user_cache)))
+    return user
+
+async def get_cached_user(user_id):
+    """fetch_cached_user, or None if the user can't be fetched for any reason (for best-effort uses like logging)"""
+    try:
+        return await fetch_cached_user(user_id)
+    except Exception as e:
+        logger.warning(f"Could not fetch user {user_id}: {e}")
+        return None
+
+async def log_user(user_id):
+    """User to show in send_log; falls back to a mention so the entry is never dropped"""
+    return await get_cached_user(user_id) or f"<@{user_id}>"
+
+class DmDispatcher:
+    """DM queue drained by DM_CONCURRENCY senders that start at most one DM per DM_INTERVAL.
+
+    Callers enqueue and move on. Rate limits and Discord/network errors are retried with
+    backoff; a rate limit pushes every sender back, not just the one that hit it. on_status
+    gets "sent", "dms_closed" or "failed: <reason>" once so it can be saved on the record.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.next_send = 0.0  # loop time the next DM may start
+        self.tasks = []
+
+    def send(self, user_id, embed, on_status=None):
+        self.queue.put_nowait((int(user_id), embed, on_status, time.perf_counter()))
+        self.start()
+
+    def start(self):
+        self.tasks = [task for task in self.tasks if not task.done()]
+        while len(self.tasks) < DM_CONCURRENCY:
+            self.tasks.append(asyncio.create_task(self.run()))
+        return self.tasks
+
+    async def pace(self, delay=0):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self.next_send = max(self.next_send, now + delay)
+        slot = self.next_send
+        self.next_send = slot + DM_INTERVAL
+        await asyncio.sleep(slot - now)
+
+    async def deliver(self, user_id, embed):
+        delay = 0
+        for attempt in range(DM_RETRIES + 1):
+            await self.pace(delay)
+            try:
+                user = await fetch_cached_user(user_id)
+                await user.send(embed=embed)
+                return "sent"
+            except discord.Forbidden:
+                return "dms_closed"
+            except discord.RateLimited as e:
+                err, delay = e, max(e.retry_after, DM_BACKOFF * 2 ** attempt)
+            except discord.HTTPException as e:
+                if e.status != 429 and e.status < 500:
+                    return f"failed: {e}"
+                err, delay = e, DM_BACKOFF * 2 ** attempt
+            except NETWORK_ERRORS as e:
+                err, delay = e, DM_BACKOFF * 2 ** attempt
+            except Exception as e:
+                return f"failed: {e}"
+        return f"failed: {err}"
+
+    async def run(self):
+        while True:
+            user_id, embed, on_status, queued_at = await self.queue.get()
+            status = await self.deliver(user_id, embed)
+            dm_latency.observe(status.split(":")[0], time.perf_counter() - queued_at)
+            if status != "sent":
+                logger.warning(f"DM to {user_id}: {status}")
+            if on_status:
+                try:
+                    on_status(status)
+                except Exception as e:
+                    logger.error(f"Saving DM status for {user_id} failed: {e}")
+
+dm_dispatcher = DmDispatcher()
+
+# ---------------- VPS Helpers ----------------
+# Pass the keys that changed; calling with no keys rewrites the whole snapshot
+@instrumented(persist_latency, "vps")
+def persist_vps(*cids):
+    vps_store.commit(vps_db, cids)
+    for cid in cids or list(vps_db):
+        schedule_vps_expiry(cid)
+    # A stop/suspend/delete may have freed capacity for queued deploys
+    admission.notify()
+
+@instrumented(persist_latency, "users")
+def persist_users(*uids): users_store.commit(users, uids)
+
+@instrumented(persist_latency, "renew_mode")
+def persist_renew_mode(): save_json(RENEW_MODE_FILE, renew_mode)
+
+@instrumented(persist_latency, "giveaways")
+def persist_giveaways(*giveaway_ids):
+    giveaway_store.commit(giveaways, giveaway_ids)
+    for giveaway_id in giveaway_ids or list(giveaways):
+        schedule_giveaway_end(giveaway_id)
+
+async def no_progress(stage):
+    pass
+
+async def create_vps(owner_id, ram=DEFAULT_RAM_GB, cpu=DEFAULT_CPU, disk=DEFAULT_DISK_GB, paid=False, giveaway=False, admission_timeout=ADMISSION_QUEUE_TIMEOUT, progress=None):
+    """Deploy a VPS; progress is an optional async callback given each stage as it completes"""
+    uid = str(owner_id)
+    progress = progress or no_progress
+    started = time.perf_counter()
+    with create_vps_latency.time("admission"):
+        token, node, reason = await admission.admit(ram, cpu, disk, timeout=admission_timeout)
+    if reason:
+        return {'error': reason}
+    try:
+        await progress(f"Placed on node {node.name}")
+        with create_vps_latency.time("warm_claim"):
+            claimed = await claim_warm_container(ram, cpu, disk, node) if WARM_POOL_SIZE else None
+        if claimed:
+            cid, http_port = claimed
+            await progress("Container started")
+            await progress("Packages ready")
+        else:
+            with create_vps_latency.time("run"):
+                cid, http_port, err = await docker_run_container(ram, cpu, disk, node=node)
+            if err: 
+                return {'error': err}
+            await progress("Container started")
+            
+            # Setup environment (waits for the container to boot)
+            with create_vps_latency.time("setup"):
+                success, setup_err = await setup_vps_environment(cid)
+            if not success:
+                logger.warning(f"Setup had issues for {cid}: {setup_err}")
+            await progress("Packages ready")
+        
+        # Generate SSH
+        with create_vps_latency.time("ssh"):
+            ssh, ssh_err = await docker_exec_capture_ssh(cid)
+        await progress("SSH ready")
+        
+        # Check systemctl status
+        with create_vps_latency.time("systemctl"):
+            systemctl_works = await check_systemctl_status(cid)
+        
+        created = datetime.utcnow()
+        expires = created + timedelta(days=VPS_LIFETIME_DAYS)
+        rec = {
+            "owner": uid,
+            "container_id": cid,
+            "name": f"vps-{container_slots[cid]['name']}",
+            "node": node.name,
+            "ram": ram,
+            "cpu": cpu,
+            "disk": disk,
+            "http_port": http_port,
+            "ssh": ssh,
+            "created_at": created.isoformat(),
+            "expires_at": expires.isoformat(),
+            "active": True,
+            "suspended": False,
+            "paid_plan": paid,
+            "giveaway_vps": giveaway,
+            "shared_with": [],
+            "additional_ports": [],
+            "systemctl_working": systemctl_works
+        }
+        vps_db[cid] = rec
+        persist_vps(cid)
+        create_vps_latency.observe("total", time.perf_counter() - started)
+    finally:
+        # The record (if any) now carries the allocation
+        admission.release(token)
+    
+    # Send log
+    await send_log("VPS Created", await log_user(uid), f"Node: {node.name}, RAM: {ram}GB, CPU: {cpu}, Disk: {disk}GB, Systemctl: {'✅' if systemctl_works else '❌'}", cid)
+    
+    return rec
+
+def get_user_vps(user_id):
+    uid = str(user_id)
+    if isinstance(vps_store, SqliteVpsStore):
+        return [vps_db[cid] for cid in vps_store.cids_for_user(uid) if cid in vps_db]
+    return [vps for vps in vps_db.values() if vps['owner'] == uid or uid in vps.get('shared_with', [])]
+
+def can_manage_vps(user_id, container_id):
+    if user_id in ADMIN_IDS:
+        return True
+    vps = vps_db.get(container_id)
+    if not vps:
+        return False
+    uid = str(user_id)
+    return vps['owner'] == uid or uid in vps.get('shared_with', [])
+
+def get_resource_usage():
+    """Live container usage as a percentage of the healthy nodes' combined capacity, plus the configured totals"""
+    total_ram = sum(vps['ram'] for vps in vps_db.values())
+    total_cpu = sum(vps['cpu'] for vps in vps_db.values())
+    total_disk = sum(vps['disk'] for vps in vps_db.values())
+    
+    hosts = [node.capacity() for node in nodes.values() if node.healthy]
+    host_ram = sum(h['ram_gb'] for h in hosts)
+    host_cpu = sum(h['cpus'] for h in hosts)
+    # Only the local node reports disk
+    host_disk = sum(h['disk_gb'] for h in hosts if h['disk_gb'] is not None)
+    host_disk_used = sum(h['disk_used_gb'] for h in hosts if h['disk_used_gb'] is not None)
+    used_cpu, used_ram = telemetry.totals()
+    used_ram_gb = used_ram / 1024 ** 3
+    
+    return {
+        'ram': min(used_ram_gb / host_ram * 100, 100) if host_ram else 0,
+        'cpu': min(used_cpu / host_cpu * 100, 100) if host_cpu else 0,
+        'disk': min(host_disk_used / host_disk * 100, 100) if host_disk else 0,
+        'used_ram': used_ram_gb,
+        'used_cpu': used_cpu,
+        'host_ram': host_ram,
+        'host_cpu': host_cpu,
+        'host_disk': host_disk,
+        'total_ram': total_ram,
+        'total_cpu': total_cpu,
+        'total_disk': total_disk,
+        'nodes': {name: {'healthy': bool(node.healthy), 'draining': node.draining} for name, node in nodes.items()}
+    }
+
+# ---------------- Lifecycle ----------------
+class LifecycleEngine:
+    """Per-container locks and desired states for VPS start/stop/restart/remove.
+
+    Single and bulk operations take the same locks, so a user's Restart and an admin's stop on
+    one container run one after the other. Bulk operations are grouped per node into batched
+    backend calls of BULK_BATCH_SIZE, BULK_CONCURRENCY batches at a time.
+    """
+
+    ACTIONS = {"running": "start", "stopped": "stop", "removed": "remove"}
+
+    def __init__(self):
+        self.locks = {}  # container_id -> asyncio.Lock
+        self.desired = {}  # container_id -> "running" | "stopped", as last requested
+
+    def lock(self, container_id):
+        return self.locks.setdefault(container_id, asyncio.Lock())
+
+    def forget(self, container_id):
+        self.locks.pop(container_id, None)
+        self.desired.pop(container_id, None)
+
+    async def set_state(self, container_id, state):
+        """Move one container to "running", "stopped" or "removed"; returns whether Docker did it"""
+        async with self.lock(container_id):
+            if state == "removed":
+                await port_forwarder.close_container(container_id)
+                ok = await docker_remove_container(container_id)
+                self.forget(container_id)
+                return ok
+            self.desired[container_id] = state
+            if state == "running":
+                ok = await docker_start_container(container_id)
+                if ok:
+                    await port_forwarder.open_container(container_id)
+                return ok
+            # A stopped container's IP can be handed to another VPS, so its forwards go first
+            await port_forwarder.close_container(container_id)
+            ok = await docker_stop_container(container_id)
+            if not ok:
+                await port_forwarder.open_container(container_id)
+            return ok
+
+    async def restart(self, container_id):
+        async with self.lock(container_id):
+            self.desired[container_id] = "running"
+            await port_forwarder.close_container(container_id)
+            ok = await docker_restart_container(container_id)
+            # Reopened either way: the container may be running on a new IP, or still on the old one
+            await port_forwarder.open_container(container_id)
+            return ok
+
+    async def set_state_many(self, container_ids, state):
+        """Move many containers to one state with batched calls; returns {container_id: ok}"""
+        by_node = {}
+        for cid in dict.fromkeys(container_ids):
+            by_node.setdefault(node_for(cid), []).append(cid)
+        batches = [
+            (node, sorted(cids[i:i + BULK_BATCH_SIZE]))
+            for node, cids in by_node.items() for i in range(0, len(cids), BULK_BATCH_SIZE)
+        ]
+        semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+        results = {}
+
+        async def run(node, batch):
+            async with semaphore, contextlib.AsyncExitStack() as stack:
+                # Locks are taken in sorted order so overlapping bulk operations can't deadlock
+                for cid in batch:
+                    await stack.enter_async_context(self.lock(cid))
+                if state != "running":
+                    await asyncio.gather(*(port_forwarder.close_container(cid) for cid in batch))
+                try:
+                    done = set(await getattr(node.backend, f"{self.ACTIONS[state]}_many")(batch))
+                except Exception as e:
+                    logger.warning(f"Bulk {self.ACTIONS[state]} of {len(batch)} container(s) on {node.name} failed: {e}")
+                    done = set()
+                if state == "removed":
+                    # A container that is already gone counts as removed
+                    for cid in batch:
+                        if cid not in done:
+                            with contextlib.suppress(Exception):
+                                if await node.backend.inspect(cid) is None:
+                                    done.add(cid)
+                for cid in batch:
+                    results[cid] = cid in done
+                    # A failed call leaves the request with the caller (e.g. expiry retries)
+                    if cid not in done:
+                        continue
+                    if state == "removed":
+                        await forget_container(cid)
+                    else:
+                        self.desired[cid] = state
+                # Forwards follow the container: open where it now runs or where a stop/remove failed
+                reopen = [cid for cid in batch if (cid in done) == (state == "running")]
+                await asyncio.gather(*(port_forwarder.open_container(cid) for cid in reopen))
+
+        await asyncio.gather(*(run(node, batch) for node, batch in batches))
+        if state == "removed":
+            for cid, ok in results.items():
+                if ok:
+                    self.forget(cid)
+        return results
+
+    async def reconcile(self, listings=None):
+        """Compare vps_db with one container listing per node and fix whichever side is wrong.
+
+        Suspended VPSes and containers with a requested state are brought back to it; otherwise
+        the record's 'active' flag is updated to whether the container is actually running.
+        listings ({node name: containers}) reuses listings the caller already has.
+        """
+        listings = dict(listings or {})
+        listed, listed_nodes = {}, set()
+
+        async def list_node(node):
+            try:
+                containers = listings.get(node.name)
+                if containers is None:
+                    containers = await node.backend.list_containers()
+                for c in containers:
+                    listed[c["id"]] = c["state"]
+                listed_nodes.add(node.name)
+            except Exception as e:
+                logger.warning(f"Reconcile couldn't list containers on {node.name}: {e}")
+
+        await asyncio.gather(*(list_node(node) for node in nodes.values() if node.healthy))
+        changed, to_start, to_stop = [], [], []
+        for cid, rec in list(vps_db.items()):
+            if node_for(cid).name not in listed_nodes:
+                continue
+            state = listed.get(cid)
+            running = state == "running"
+            if rec.get('suspended') or self.desired.get(cid) == "stopped":
+                if running:
+                    to_stop.append(cid)
+                if rec.get('active', True):
+                    rec['active'] = False
+                    changed.append(cid)
+                continue
+            if self.desired.get(cid) == "running" and state is not None and not running:
+                to_start.append(cid)
+                continue
+            if state is None:
+                logger.warning(f"Container {cid} of VPS owned by {rec.get('owner')} no longer exists")
+            if rec.get('active', True) != running:
+                rec['active'] = running
+                changed.append(cid)
+        if to_stop:
+            await self.set_state_many(to_stop, "stopped")
+        if to_start:
+            await self.set_state_many(to_start, "running")
+        if changed:
+            persist_vps(*changed)
+        summary = {'checked': len(vps_db), 'updated': len(changed), 'started': len(to_start), 'stopped': len(to_stop)}
+        logger.info(f"Reconciled VPS records with Docker: {summary}")
+        return summary
+
+lifecycle = LifecycleEngine()
+
+async def suspend_vps_many(container_ids):
+    """Stop and suspend VPSes in batches; returns {container_id: stopped}.
+
+    Only VPSes whose container stopped are marked suspended, so a container still running keeps
+    counting against its node's capacity.
+    """
+    results = await lifecycle.set_state_many(container_ids, "stopped")
+    stopped = [cid for cid, ok in results.items() if ok and cid in vps_db]
+    for cid in stopped:
+        vps_db[cid]['active'] = False
+        vps_db[cid]['suspended'] = True
+    failed = [cid for cid, ok in results.items() if not ok]
+    if failed:
+        logger.warning(f"Failed to stop {len(failed)} container(s) for suspension: {', '.join(failed[:10])}")
+    if stopped:
+        persist_vps(*stopped)
+    return results
+
+async def unsuspend_vps_many(container_ids):
+    """Start and unsuspend VPSes in batches; returns {container_id: started}"""
+    results = await lifecycle.set_state_many(container_ids, "running")
+    for cid, ok in results.items():
+        if cid in vps_db:
+            vps_db[cid]['active'] = ok
+            vps_db[cid]['suspended'] = False
+    persist_vps(*[cid for cid in results if cid in vps_db])
+    return results
+
+async def delete_vps_many(container_ids):
+    """Remove containers in batches and drop their records; returns {container_id: removed}.
+
+    A container that couldn't be removed keeps its record and slots, so it still counts
+    against its node and its port and name aren't handed out again.
+    """
+    results = await lifecycle.set_state_many(container_ids, "removed")
+    removed = [cid for cid, ok in results.items() if ok]
+    for cid in removed:
+        vps_db.pop(cid, None)
+    failed = [cid for cid, ok in results.items() if not ok]
+    if failed:
+        logger.warning(f"Failed to remove {len(failed)} container(s): {', '.join(failed[:10])}")
+    if removed:
+        persist_vps(*removed)
+    return results
+
+# ---------------- Interaction Jobs ----------------
+class InteractionJob:
+    """A slow operation behind a deferred interaction; each stage edits the original response(s)"""
+
+    def __init__(self, job_id, key, title):
+        self.id = job_id
+        self.key = key
+        self.title = title
+        self.stages = []  # (stage, seconds since start)
+        self.interactions = []  # Every interaction (repeat clicks included) showing this job
+        self.result = None  # Final str or discord.Embed from the work function
+        self.error = None
+        self.done = False
+        self.started = datetime.utcnow()
+        self.task = None
+        self.render_task = None
+        self.dirty = False
+
+    def embed(self):
+        if self.done and isinstance(self.result, discord.Embed):
+            embed = self.result
+        else:
+            color = discord.Color.red() if self.error else discord.Color.green() if self.done else discord.Color.blue()
+            embed = discord.Embed(title=f"{'❌' if self.error else '✅' if self.done else '⏳'} {self.title}", color=color)
+            lines = [f"✔️ {stage} `{elapsed:.1f}s`" for stage, elapsed in self.stages]
+            if self.error:
+                lines.append(f"❌ {self.error}")
+            elif self.done and self.result:
+                lines.append(str(self.result))
+            elif not self.done:
+                lines.append("⏳ Working...")
+            embed.description = "\n".join(lines)[:4096]
+        embed.set_footer(text=f"Job #{self.id}")
+        return embed
+
+    async def stage(self, text):
+        """Record a completed stage and refresh the responses (edits are coalesced, never awaited by the work)"""
+        self.stages.append((text, (datetime.utcnow() - self.started).total_seconds()))
+        self.refresh()
+
+    def refresh(self):
+        self.dirty = True
+        if self.render_task is None or self.render_task.done():
+            self.render_task = asyncio.create_task(self.render())
+
+    async def render(self):
+        # Stages that land while an edit is in flight are folded into the next one
+        while self.dirty:
+            self.dirty = False
+            embed = self.embed()
+            await asyncio.gather(
+                *(interaction.edit_original_response(embed=embed) for interaction in list(self.interactions)),
+                return_exceptions=True
+            )
+
+    async def run(self, work):
+        try:
+            self.result = await work(self)
+        except Exception as e:
+            logger.error(f"Job #{self.id} ({self.title}) failed: {e}")
+            self.error = str(e)
+        finally:
+            self.done = True
+            interaction_jobs.pop(self.key, None)
+            self.refresh()
+            await self.render_task
+
+interaction_jobs = {}  # key -> in-flight InteractionJob
+interaction_job_state = {"next_id": 0}
+
+async def run_interaction_job(interaction, key, title, work, ephemeral=True):
+    """Defer the interaction now and run `work(job)` in the background; returns the job.
+
+    `key` identifies the operation, e.g. ("restart", container_id): while a job with that key is
+    in flight, further calls attach their interaction to it instead of starting another. `work`
+    reports progress with `await job.stage(...)` and returns a closing message or embed.
+    """
+    if not interaction.response.is_done():
+        await interaction.response.defer(thinking=True, ephemeral=ephemeral)
+        interaction_latency.observe(f"defer:{key[0] if isinstance(key, tuple) else key}", (discord.utils.utcnow() - interaction.created_at).total_seconds())
+    job = interaction_jobs.get(key)
+    if job:
+        job.interactions.append(interaction)
+        job.refresh()
+        return job
+    interaction_job_state["next_id"] += 1
+    job = InteractionJob(interaction_job_state["next_id"], key, title)
+    job.interactions.append(interaction)
+    interaction_jobs[key] = job
+    job.refresh()
+    job.task = asyncio.create_task(job.run(work))
+    return job
+
+# ---------------- Invite Tracking ----------------
+class InviteTracker:
+    """Set-backed view of every users[*]['unique_joins'] list plus a joiner -> inviter reverse index.
+
+    The lists in users stay the persisted form; the sets hold the same ids as ints so the checks
+    on every member join are O(1). Changed inviters (and invite_snapshot) are written together
+    INVITE_FLUSH_DELAY after the first change instead of once per join.
+    """
+
+    def __init__(self, users):
+        self.joins = {}  # inviter id -> set of joiner ids
+        self.inviter_of = {}  # joiner id -> inviter first credited for them
+        self.dirty = set()  # inviter uids with unsaved joins
+        self.snapshot_dirty = False
+        self.flush_task = None
+        for uid, rec in users.items():
+            for joiner in rec.get('unique_joins', []):
+                self.index(int(uid), int(joiner))
+
+    def index(self, inviter, joiner):
+        self.joins.setdefault(inviter, set()).add(joiner)
+        self.inviter_of.setdefault(joiner, inviter)
+
+    def contains(self, inviter, joiner):
+        return joiner in self.joins.get(inviter, ())
+
+    def add(self, inviter, joiner):
+        """Credit inviter with a join; False if that joiner was already counted for them"""
+        if self.contains(inviter, joiner):
+            return False
+        uid = str(inviter)
+        rec = users.setdefault(uid, {
+            "points": 0,
+            "inv_unclaimed": 0,
+            "inv_total": 0,
+            "invites": [],
+            "unique_joins": []
+        })
+        rec.setdefault('unique_joins', []).append(str(joiner))
+        rec['inv_unclaimed'] = rec.get('inv_unclaimed', 0) + 1
+        rec['inv_total'] = rec.get('inv_total', 0) + 1
+        self.index(inviter, joiner)
+        self.dirty.add(uid)
+        self.schedule_flush()
+        return True
+
+    def snapshot_changed(self):
+        self.snapshot_dirty = True
+        self.schedule_flush()
+
+    def flush(self):
+        if self.dirty:
+            dirty, self.dirty = self.dirty, set()
+            persist_users(*dirty)
+        if self.snapshot_dirty:
+            self.snapshot_dirty = False
+            with persist_latency.time("invite_snapshot"):
+                save_json(INV_CACHE_FILE, invite_snapshot)
+
+    def schedule_flush(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop to defer to (scripts, migrations): save straight away
+            self.flush()
+            return
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(INVITE_FLUSH_DELAY)
+        self.flush()
+
+with timed("build indexes"):
+    invite_tracker = InviteTracker(users)
+
+def is_unique_join(user_id, inviter_id):
+    """Check if this is a unique join (not a rejoin)"""
+    return not invite_tracker.contains(int(inviter_id), int(user_id))
+
+def add_unique_join(user_id, inviter_id):
+    """Add a unique join to inviter's record"""
+    return invite_tracker.add(int(inviter_id), int(user_id))
+
+# invite_snapshot: guild id -> {code: {"uses", "max_uses", "inviter"}}. Kept current by the invite
+# create/delete events; member joins in a burst share one fetch that is diffed against it.
+pending_joins = {}  # guild id -> members waiting for the next invite diff
+deleted_invites = {}  # guild id -> {code: snapshot entry} deleted since the last diff
+invite_diff_tasks = {}  # guild id -> running diff task
+
+def invite_entry(invite):
+    return {
+        "uses": invite.uses or 0,
+        "max_uses": invite.max_uses or 0,
+        "inviter": invite.inviter.id if invite.inviter else None
+    }
+
+async def fetch_guild_invites(guild):
+    """{code: entry} for the guild, or None if the bot can't list invites"""
+    try:
+        return {invite.code: invite_entry(invite) for invite in await guild.invites()}
+    except discord.HTTPException as e:
+        logger.warning(f"Could not fetch invites for guild {guild.id}: {e}")
+        return None
+
+def diff_invite_uses(old, current, deleted):
+    """[(inviter, uses gained)] between two snapshots; a deleted invite one use short of max_uses was used up"""
+    gained = []
+    for code, entry in current.items():
+        delta = entry["uses"] - old.get(code, {}).get("uses", 0)
+        if delta > 0 and entry["inviter"]:
+            gained.append((entry["inviter"], delta))
+    for code, entry in deleted.items():
+        if code not in current and entry["max_uses"] and entry["uses"] + 1 >= entry["max_uses"] and entry["inviter"]:
+            gained.append((entry["inviter"], 1))
+    return gained
+
+async def process_pending_joins(guild):
+    """Attribute queued joins with one invite fetch per burst.
+
+    Discord doesn't say which invite a member used. When several invites gain uses in the same
+    burst, joins are paired with inviters in order, so each inviter's count is right even if
+    the member-to-inviter pairing within the burst isn't. If the fetch fails, the burst goes back
+    in front of later joins and is retried with backoff, keeping joins and uses in step.
+    """
+    key = str(guild.id)
+    delay = INVITE_DIFF_DELAY
+    while pending_joins.get(guild.id):
+        await asyncio.sleep(delay)
+        members = pending_joins.pop(guild.id)
+        deleted = deleted_invites.pop(guild.id, {})
+        current = await fetch_guild_invites(guild)
+        if current is None:
+            pending_joins[guild.id] = members + pending_joins.get(guild.id, [])
+            deleted_invites[guild.id] = {**deleted, **deleted_invites.get(guild.id, {})}
+            delay = min(delay * 2, INVITE_RETRY_MAX_DELAY)
+            logger.warning(f"Guild {guild.id}: {len(pending_joins[guild.id])} join(s) waiting, retrying invite fetch in {delay}s")
+            continue
+        delay = INVITE_DIFF_DELAY
+        gained = diff_invite_uses(invite_snapshot.get(key, {}), current, deleted)
+        invite_snapshot[key] = current
+        invite_tracker.snapshot_changed()
+        credits = [inviter for inviter, uses in gained for _ in range(uses)]
+        if len(credits) != len(members):
+            logger.info(f"Guild {guild.id}: {len(members)} join(s) but {len(credits)} invite use(s) gained")
+        for member, inviter_id in zip(members, credits):
+            if inviter_id != member.id and add_unique_join(member.id, inviter_id):
+                await send_log("Invite Join", member, f"Invited by <@{inviter_id}>")
+
+@bot.event
+async def on_ready():
+    logger.info(f"Logged in as {bot.user}")
+    log_startup_report("Discord ready")
+    for guild in bot.guilds:
+        current = await fetch_guild_invites(guild)
+        if current is not None:
+            invite_snapshot[str(guild.id)] = current
+    invite_tracker.snapshot_changed()
+
+@bot.event
+async def on_app_command_completion(interaction, command):
+    interaction_latency.observe(command.qualified_name, (discord.utils.utcnow() - interaction.created_at).total_seconds())
+
+@bot.event
+async def on_invite_create(invite):
+    if invite.guild:
+        invite_snapshot.setdefault(str(invite.guild.id), {})[invite.code] = invite_entry(invite)
+        invite_tracker.snapshot_changed()
+
+@bot.event
+async def on_invite_delete(invite):
+    if not invite.guild:
+        return
+    entry = invite_snapshot.get(str(invite.guild.id), {}).pop(invite.code, None)
+    if entry:
+        # Invites hitting max_uses are deleted by Discord; the next diff counts that last use
+        deleted_invites.setdefault(invite.guild.id, {})[invite.code] = entry
+        invite_tracker.snapshot_changed()
+
+@bot.event
+async def on_member_join(member):
+    if member.bot:
+        return
+    pending_joins.setdefault(member.guild.id, []).append(member)
+    task = invite_diff_tasks.get(member.guild.id)
+    if task is None or task.done():
+        invite_diff_tasks[member.guild.id] = asyncio.create_task(process_pending_joins(member.guild))
+
+# ---------------- Background Tasks ----------------
+class DeadlineScheduler:
+    """Min-heap of (deadline, kind, key) that sleeps until the earliest deadline instead of polling.
+
+    Rescheduling or cancelling only updates self.deadlines; superseded heap entries are
+    skipped when they surface. Due items run through their kind's handler in batches
+    capped by EXPIRY_CONCURRENCY.
+    """
+
+    def __init__(self, concurrency):
+        self.heap = []
+        self.deadlines = {}  # (kind, key) -> deadline currently in force
+        self.handlers = {}  # kind -> (async handler, batch)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def register(self, kind, handler, batch=False):
+        """handler(key) per due item, or handler([keys]) once per wakeup for batch kinds"""
+        self.handlers[kind] = (handler, batch)
+
+    def schedule(self, kind, key, when):
+        if self.deadlines.get((kind, key)) == when:
+            return
+        self.deadlines[(kind, key)] = when
+        heapq.heappush(self.heap, (when, kind, key))
+        # Rebuild once stale entries dominate so renew-heavy workloads don't grow the heap forever
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(w, k, key) for (k, key), w in self.deadlines.items()]
+            heapq.heapify(self.heap)
+        if self.heap[0][0] == when:
+            self.wakeup.set()
+
+    def cancel(self, kind, key):
+        self.deadlines.pop((kind, key), None)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def fire(self, kind, key):
+        async with self.semaphore:
+            try:
+                with scheduler_latency.time(kind):
+                    await self.handlers[kind][0](key)
+            except Exception as e:
+                logger.error(f"Scheduled {kind} job for {key} failed: {e}")
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = datetime.utcnow()
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                when, kind, key = heapq.heappop(self.heap)
+                if self.deadlines.get((kind, key)) == when:
+                    del self.deadlines[(kind, key)]
+                    due.append((kind, key))
+            if due:
+                batches = {}
+                for kind, key in due:
+                    if self.handlers[kind][1]:
+                        batches.setdefault(kind, []).append(key)
+                await asyncio.gather(
+                    *(self.fire(kind, key) for kind, key in due if not self.handlers[kind][1]),
+                    *(self.fire(kind, keys) for kind, keys in batches.items())
+                )
+                continue
+            timeout = (self.heap[0][0] - now).total_seconds() if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+deadline_scheduler = DeadlineScheduler(EXPIRY_CONCURRENCY)
+
+def schedule_vps_expiry(cid):
+    """Keep the scheduler in line with vps_db[cid]; called on every persist so renew/suspend/delete are picked up"""
+    rec = vps_db.get(cid)
+    if rec and rec.get('active', True) and not rec.get('suspended'):
+        deadline_scheduler.schedule("vps", cid, datetime.fromisoformat(rec['expires_at']))
+    else:
+        deadline_scheduler.cancel("vps", cid)
+
+def schedule_giveaway_end(giveaway_id):
+    giveaway = giveaways.get(giveaway_id)
+    if giveaway and giveaway['status'] == 'active':
+        deadline_scheduler.schedule("giveaway", giveaway_id, datetime.fromisoformat(giveaway['end_time']))
+    else:
+        deadline_scheduler.cancel("giveaway", giveaway_id)
+
+def expiry_embed(rec):
+    embed = discord.Embed(title="⏰ Your VPS Has Expired", color=discord.Color.red())
+    embed.add_field(name="Container ID", value=f"`{rec['container_id']}`", inline=False)
+    embed.add_field(name="Specs", value=f"**{rec['ram']}GB RAM** | **{rec['cpu']} CPU** | **{rec['disk']}GB Disk**", inline=False)
+    embed.add_field(name="Status", value="🔴 Suspended", inline=True)
+    if rec.get('giveaway_vps'):
+        embed.set_footer(text="Giveaway VPSes cannot be renewed.")
+    else:
+        embed.set_footer(text="Renew it with your points to bring it back.")
+    return embed
+
+def record_notification(cid, kind, status):
+    """Save a DM outcome on the VPS record under notifications[kind]"""
+    rec = vps_db.get(cid)
+    if rec:
+        rec.setdefault('notifications', {})[kind] = status
+        persist_vps(cid)
+
+async def expire_vps(cids):
+    """Suspend every VPS that came due together, stopping their containers in batched calls"""
+    now = datetime.utcnow()
+    due = [
+        cid for cid in cids
+        if cid in vps_db and vps_db[cid].get('active', True) and now >= datetime.fromisoformat(vps_db[cid]['expires_at'])
+    ]
+    if not due:
+        return
+    results = await suspend_vps_many(due)
+    retry_at = now + timedelta(seconds=EXPIRY_RETRY_DELAY)
+    for cid in due:
+        if not results.get(cid):
+            deadline_scheduler.schedule("vps", cid, retry_at)
+    due = [cid for cid in due if results.get(cid)]
+
+    # Log expiration and tell the owners without waiting on their DMs
+    async def log_expired(cid):
+        owner = vps_db[cid]['owner']
+        await send_log("VPS Expired", await log_user(owner), "Auto-suspended due to expiry", cid)
+        dm_dispatcher.send(owner, expiry_embed(vps_db[cid]), functools.partial(record_notification, cid, "expiry"))
+
+    await asyncio.gather(*(log_expired(cid) for cid in due))
+
+def start_deadline_scheduler():
+    """Seed the scheduler from the loaded data and resume interrupted giveaway provisioning"""
+    # SQLite hands back active VPSes already in deadline order, so the pushes never sift
+    for cid in (vps_store.cids_by_expiry() if isinstance(vps_store, SqliteVpsStore) else vps_db):
+        schedule_vps_expiry(cid)
+    for giveaway_id, giveaway in giveaways.items():
+        if giveaway['status'] == 'provisioning':
+            start_giveaway_provisioning(giveaway_id)
+        else:
+            schedule_giveaway_end(giveaway_id)
+    deadline_scheduler.register("vps", expire_vps, batch=True)
+    deadline_scheduler.register("giveaway", end_giveaway)
+    return deadline_scheduler.start()
+
+# ---------------- Giveaway Provisioning ----------------
+# Each ended giveaway keeps its own job list in giveaway['provisioning'], persisted after every
+# deploy, so a restart resumes from the participants that are still pending.
+provision_semaphore = asyncio.Semaphore(PROVISION_CONCURRENCY)
+provision_tasks = {}  # giveaway_id -> running provisioning task
+
+def giveaway_vps_embed(rec, title):
+    embed = discord.Embed(title=title, color=discord.Color.gold())
+    embed.add_field(name="Container ID", value=f"`{rec['container_id']}`", inline=False)
+    embed.add_field(name="Specs", value=f"**{rec['ram']}GB RAM** | **{rec['cpu']} CPU** | **{rec['disk']}GB Disk**", inline=False)
+    embed.add_field(name="Expires", value=rec['expires_at'][:10], inline=True)
+    embed.add_field(name="Status", value="🟢 Active", inline=True)
+    embed.add_field(name="HTTP Access", value=f"http://{node_for(rec['container_id']).public_ip}:{rec['http_port']}", inline=False)
+    embed.add_field(name="SSH Connection", value=f"```{rec['ssh']}```", inline=False)
+    embed.set_footer(text="This is a giveaway VPS and cannot be renewed. It will auto-delete after 15 days.")
+    return embed
+
+def get_provisioning_progress(giveaway_id):
+    job = giveaways.get(giveaway_id, {}).get('provisioning')
+    if not job:
+        return None
+    return {
+        'total': job['total'],
+        'pending': len(job['pending']),
+        'succeeded': len(job['succeeded']),
+        'failed': len(job['failed']),
+        'notified': sum(status == "sent" for status in job.get('notified', {}).values())
+    }
+
+def start_giveaway_provisioning(giveaway_id, recipients=None):
+    """Queue deploys for recipients (first call) or resume the persisted queue"""
+    giveaway = giveaways[giveaway_id]
+    if recipients is not None:
+        giveaway['status'] = 'provisioning'
+        giveaway['provisioning'] = {
+            'total': len(recipients),
+            'pending': [str(r) for r in recipients],
+            'succeeded': {},
+            'failed': {}
+        }
+        persist_giveaways(giveaway_id)
+    task = provision_tasks.get(giveaway_id)
+    if task is None or task.done():
+        provision_tasks[giveaway_id] = asyncio.create_task(provision_giveaway(giveaway_id))
+
+async def provision_giveaway(giveaway_id):
+    giveaway = giveaways[giveaway_id]
+    job = giveaway['provisioning']
+    title = "🎉 You Won a VPS Giveaway!" if giveaway['winner_type'] == 'random' else "🎉 You Received a VPS from Giveaway!"
+
+    def notify(participant_id):
+        """Queue the participant's DM; the outcome lands in job['notified']"""
+        rec = vps_db.get(job['succeeded'][participant_id])
+        if not rec:
+            return
+
+        def record(status):
+            job.setdefault('notified', {})[participant_id] = status
+            persist_giveaways(giveaway_id)
+
+        dm_dispatcher.send(participant_id, giveaway_vps_embed(rec, title), record)
+
+    # DMs still queued when the bot last stopped
+    for participant_id in job['succeeded']:
+        if participant_id not in job.get('notified', {}):
+            notify(participant_id)
+
+    async def provision_one(participant_id):
+        async with provision_semaphore:
+            try:
+                # Queue on host capacity for as long as it takes rather than failing the participant
+                rec = await create_vps(int(participant_id), giveaway['vps_ram'], giveaway['vps_cpu'], giveaway['vps_disk'], giveaway=True, admission_timeout=None)
+                err = rec.get('error')
+            except Exception as e:
+                rec, err = None, str(e)
+        if err:
+            logger.error(f"Failed to create VPS for giveaway {giveaway_id} participant {participant_id}: {err}")
+            job['failed'][participant_id] = err
+        else:
+            job['succeeded'][participant_id] = rec['container_id']
+            notify(participant_id)
+        job['pending'].remove(participant_id)
+        persist_giveaways(giveaway_id)
+
+    await asyncio.gather(*(provision_one(pid) for pid in list(job['pending'])))
+
+    giveaway['status'] = 'ended'
+    giveaway['vps_created'] = bool(job['succeeded'])
+    if giveaway['winner_type'] == 'random' and job['succeeded']:
+        giveaway['winner_vps_id'] = next(iter(job['succeeded'].values()))
+    persist_giveaways(giveaway_id)
+    progress = get_provisioning_progress(giveaway_id)
+    logger.info(f"Giveaway {giveaway_id} provisioning finished: {progress}")
+    await send_log("Giveaway Ended", "System", f"{progress['succeeded']}/{progress['total']} VPS created, {progress['failed']} failed", giveaway_id)
+
+async def end_giveaway(giveaway_id):
+    giveaway = giveaways.get(giveaway_id)
+    if not giveaway or giveaway['status'] != 'active':
+        return
+    # Giveaway ended, select winner
+    participants = giveaway.get('participants', [])
+    if not participants:
+        giveaway['status'] = 'ended'
+        persist_giveaways(giveaway_id)
+    elif giveaway['winner_type'] == 'random':
+        winner_id = random.choice(participants)
+        giveaway['winner_id'] = winner_id
+        start_giveaway_provisioning(giveaway_id, [winner_id])
+    elif giveaway['winner_type'] == 'all':
+        # Create VPS for all participants, PROVISION_CONCURRENCY at a time
+        start_giveaway_provisioning(giveaway_id, participants)
+
+# ---------------- Entry Point ----------------
+if __name__ == "__main__":
+    if "--worker" in sys.argv:
+        asyncio.run(run_worker())
+    else:
+        bot.run(TOKEN)
@@ -0,0 +1,56 @@
+import importlib.util
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """A freshly imported bot module whose data/ lives in tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    spec = importlib.util.spec_from_file_location("bot", os.path.join(ROOT, "bot.py"))
+    module = importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules, "bot", module)
+    spec.loader.exec_module(module)
+    module.WARM_POOL_SIZE = 0
+    module.METRICS_PORT = 0
+
+    async def fetch_user(uid):
+        raise module.discord.NotFound(type("Response", (), {"status": 404, "reason": "Not Found"})(), "unknown user")
+
+    module.bot.fetch_user = fetch_user
+    return module
+
+@pytest.fixture
+def fake_nodes(bot):
+    """make(*names) replaces the node registry with fake:// nodes and returns them"""
+    def make(*names, ncpu=16, mem_gb=64):
+        bot.nodes.clear()
+        for i, name in enumerate(names):
+            node = bot.DockerNode(name, f"fake://{name}", f"10.0.0.{i + 1}")
+            node.backend = bot.FakeDockerBackend(ncpu=ncpu, mem_gb=mem_gb)
+            bot.nodes[name] = node
+        bot.DEFAULT_NODE = names[0]
+        return [bot.nodes[name] for name in names]
+    return make
+
+def add_vps(bot, node, owner="1", state="running", expires_in=timedelta(days=1), **fields):
+    """Put a container on a fake node and a matching vps_db record; returns the container id"""
+    number = bot.name_numbers.allocate()
+    port = node.http_ports.allocate()
+    cid = f"{node.name}{number:08x}"
+    node.backend.containers[cid] = {"name": f"vps-{number}", "image": "x", "state": state, "ram": 1, "cpu": 1, "disk": 10, "ports": {80: port}, "ip": f"172.18.{number // 250}.{number % 250 + 2}"}
+    bot.claim_slots(node, cid, number, [port])
+    now = datetime.utcnow()
+    bot.vps_db[cid] = {
+        "owner": str(owner), "container_id": cid, "name": f"vps-{number}", "node": node.name,
+        "ram": 1, "cpu": 1, "disk": 10, "http_port": port, "ssh": "ssh x@tmate.io",
+        "created_at": now.isoformat(), "expires_at": (now + expires_in).isoformat(),
+        "active": state == "running", "suspended": False, "paid_plan": False, "giveaway_vps": False,
+        "shared_with": [], "additional_ports": [], "systemctl_working": True, **fields
+    }
+    bot.persist_vps(cid)
+    return cid
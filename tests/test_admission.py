@@ -0,0 +1,41 @@
+import asyncio
+
+from conftest import add_vps
+
+def test_allocation_counts_running_vps_and_disk_of_all(bot, fake_nodes):
+    node, = fake_nodes("a")
+    add_vps(bot, node, ram=4, cpu=2, disk=20)
+    add_vps(bot, node, ram=8, cpu=4, disk=30, suspended=True)
+    assert bot.admission.allocated(node) == {"ram": 4, "cpu": 2, "disk": 50}
+
+def test_deploy_queues_until_capacity_is_released(bot, fake_nodes):
+    async def main():
+        node, = fake_nodes("a", ncpu=4, mem_gb=16)
+        await bot.prepare_docker_host()
+        # 16GB * RAM_OVERCOMMIT 1.5 = 24GB allocatable
+        token, placed, reason = await bot.admission.admit(20, 1, 10, timeout=0)
+        assert placed is node and reason is None
+
+        waiter = asyncio.create_task(bot.admission.admit(8, 1, 10, timeout=5))
+        await asyncio.sleep(0.05)
+        assert not waiter.done() and bot.admission.waiting == 1
+
+        bot.admission.release(token)
+        second, placed, reason = await asyncio.wait_for(waiter, 1)
+        assert second and placed is node and reason is None
+        assert bot.admission.waiting == 0
+
+        _, _, reason = await bot.admission.admit(20, 1, 10, timeout=0)
+        assert "Not enough capacity on a" in reason and "waited 0s" in reason
+
+    asyncio.run(main())
+
+def test_deploy_that_can_never_fit_is_rejected_without_queueing(bot, fake_nodes):
+    async def main():
+        fake_nodes("a", "b", ncpu=4, mem_gb=16)
+        await bot.prepare_docker_host()
+        token, node, reason = await bot.admission.admit(100, 1, 10, timeout=5)
+        assert token is None and node is None
+        assert reason.startswith("Requested 100GB RAM exceeds the limit of every node")
+
+    asyncio.run(main())
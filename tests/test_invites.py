@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+
+def entry(uses, inviter, max_uses=0):
+    return {"uses": uses, "max_uses": max_uses, "inviter": inviter}
+
+def test_diff_credits_uses_gained_and_used_up_invites(bot):
+    old = {"a": entry(1, 1), "b": entry(0, 2), "gone": entry(4, 3, max_uses=5)}
+    current = {"a": entry(3, 1), "b": entry(0, 2), "new": entry(1, 4), "anon": entry(2, None)}
+    deleted = {
+        "gone": entry(4, 3, max_uses=5),  # one use short of max_uses: Discord deleted it on use
+        "revoked": entry(1, 5, max_uses=5),  # deleted by hand
+        "unlimited": entry(7, 6),
+    }
+    assert sorted(bot.diff_invite_uses(old, current, deleted)) == [(1, 2), (3, 1), (4, 1)]
+
+def test_joins_are_requeued_in_order_while_invites_cannot_be_fetched(bot):
+    async def main():
+        bot.INVITE_DIFF_DELAY = 0.05
+        invites = {"a": entry(0, 1), "b": entry(0, 2)}
+        failures = [2]
+
+        class Guild:
+            id = 9
+
+            async def invites(self):
+                if failures[0]:
+                    failures[0] -= 1
+                    raise bot.discord.HTTPException(SimpleNamespace(status=500, reason="down"), "down")
+                return [
+                    SimpleNamespace(code=code, uses=e["uses"], max_uses=0, inviter=SimpleNamespace(id=e["inviter"]))
+                    for code, e in invites.items()
+                ]
+
+        guild = Guild()
+        bot.invite_snapshot["9"] = {code: dict(e) for code, e in invites.items()}
+
+        def member(uid):
+            return SimpleNamespace(id=uid, bot=False, guild=guild, name=str(uid), mention=f"<@{uid}>")
+
+        for uid in (100, 101):
+            invites["a"]["uses"] += 1
+            await bot.on_member_join(member(uid))
+        await asyncio.sleep(0.08)
+        # The first fetch has failed; a later join lands behind the burst that is waiting
+        assert [m.id for m in bot.pending_joins[9]] == [100, 101]
+        invites["b"]["uses"] += 1
+        await bot.on_member_join(member(102))
+        await bot.invite_diff_tasks[9]
+
+        assert failures == [0]
+        assert bot.invite_tracker.joins == {1: {100, 101}, 2: {102}}
+        assert bot.invite_snapshot["9"]["a"]["uses"] == 2
+
+    asyncio.run(main())
@@ -0,0 +1,46 @@
+import asyncio
+import os
+
+def test_calls_run_on_worker_and_errors_come_back(bot, fake_nodes):
+    async def main():
+        node, = fake_nodes("a")
+        bot.enable_job_queue()
+        worker = asyncio.create_task(bot.run_worker(bot.JobQueue(bot.JOB_DB_FILE), concurrency=4))
+        await bot.prepare_docker_host()
+        backend = node.backend
+        assert isinstance(backend, bot.QueuedDockerBackend)
+
+        cid, err = await backend.run_container("vps-1234", "img", 1, 1, {80: 3000})
+        assert err is None and cid in backend.inner.containers
+        assert await backend.stop(cid)
+        assert backend.inner.containers[cid]["state"] == "exited"
+
+        async def timeout(*args, **kwargs):
+            raise asyncio.TimeoutError()
+
+        backend.inner.exec = timeout
+        try:
+            await backend.exec(cid, ["true"], 1)
+            raise AssertionError("timeout was not propagated")
+        except asyncio.TimeoutError:
+            pass
+        assert bot.job_queue.conn.execute("SELECT COUNT(*) FROM jobs").fetchone() == (0,)
+        worker.cancel()
+
+    asyncio.run(main())
+
+def test_jobs_of_a_previous_bot_process_never_run(bot):
+    old_bot = bot.JobQueue(bot.JOB_DB_FILE, session="999999999")
+    with old_bot.conn:
+        old_bot.conn.execute("INSERT INTO jobs (node, op, args, session) VALUES ('a', 'run_container', '[]', '999999999')")
+    worker = bot.JobQueue(bot.JOB_DB_FILE)
+    # That bot is gone, so its jobs aren't claimed
+    assert worker.claim(10) == []
+
+    bot.enable_job_queue()
+    assert bot.job_queue.conn.execute("SELECT COUNT(*) FROM jobs").fetchone() == (0,)
+    with bot.job_queue.conn:
+        bot.job_queue.conn.execute(
+            "INSERT INTO jobs (node, op, args, session) VALUES ('a', 'stop', '[\"c\"]', ?)", (str(os.getpid()),)
+        )
+    assert [row[2] for row in worker.claim(10)] == ["stop"]
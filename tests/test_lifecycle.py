@@ -0,0 +1,92 @@
+import asyncio
+from datetime import timedelta
+
+from conftest import add_vps
+
+def test_reconcile_fixes_both_sides_in_one_pass(bot, fake_nodes):
+    async def main():
+        a, b = fake_nodes("a", "b")
+        await bot.prepare_docker_host()
+        running = add_vps(bot, a)
+        exited = add_vps(bot, b, state="exited")
+        bot.vps_db[exited]["active"] = True
+        suspended = add_vps(bot, a, suspended=True)
+        wanted_running = add_vps(bot, b, state="exited")
+        bot.lifecycle.desired[wanted_running] = "running"
+        missing = add_vps(bot, a)
+        del a.backend.containers[missing]
+        calls_before = len(a.backend.calls) + len(b.backend.calls)
+
+        await bot.lifecycle.reconcile()
+
+        assert bot.vps_db[running]["active"]
+        assert not bot.vps_db[exited]["active"]
+        assert a.backend.containers[suspended]["state"] == "exited" and not bot.vps_db[suspended]["active"]
+        assert b.backend.containers[wanted_running]["state"] == "running"
+        assert not bot.vps_db[missing]["active"]
+        # The listing is one call per node; the only container calls are the stop and the start
+        assert len(a.backend.calls) + len(b.backend.calls) - calls_before == 2
+
+    asyncio.run(main())
+
+def test_expiry_retries_container_that_failed_to_stop(bot, fake_nodes):
+    async def main():
+        node, = fake_nodes("a")
+        bot.EXPIRY_RETRY_DELAY = 0.2
+        cid = add_vps(bot, node, expires_in=timedelta(seconds=-1))
+        stop_many = node.backend.stop_many
+        broken = [True]
+
+        async def flaky_stop_many(ids):
+            return [] if broken[0] else await stop_many(ids)
+
+        node.backend.stop_many = flaky_stop_many
+        bot.start_deadline_scheduler()
+        await asyncio.sleep(0.1)
+        # Still running, so it still counts against the node and is not marked suspended
+        assert bot.vps_db[cid]["active"] and not bot.vps_db[cid]["suspended"]
+        assert ("vps", cid) in bot.deadline_scheduler.deadlines
+
+        broken[0] = False
+        await asyncio.sleep(0.3)
+        assert bot.vps_db[cid]["suspended"]
+        bot.deadline_scheduler.task.cancel()
+
+    asyncio.run(main())
+
+def test_bulk_delete_keeps_records_of_containers_that_were_not_removed(bot, fake_nodes):
+    async def main():
+        node, = fake_nodes("a")
+        removed, stuck, gone = (add_vps(bot, node) for _ in range(3))
+        stuck_port = bot.vps_db[stuck]["http_port"]
+        del node.backend.containers[gone]
+
+        async def remove_many(ids):
+            return [cid for cid in ids if cid == removed and node.backend.containers.pop(cid)]
+
+        node.backend.remove_many = remove_many
+        results = await bot.delete_vps_many([removed, stuck, gone])
+
+        # Already gone counts as removed; a failed removal keeps the record and the slots
+        assert results == {removed: True, stuck: False, gone: True}
+        assert set(bot.vps_db) == {stuck}
+        assert stuck in bot.container_slots and stuck_port not in node.http_ports.free
+        assert removed not in bot.container_slots and gone not in bot.container_slots
+        assert bot.admission.allocated(node)["cpu"] == 1
+
+    asyncio.run(main())
+
+def test_bulk_operations_wait_for_the_container_lock(bot, fake_nodes):
+    async def main():
+        node, = fake_nodes("a")
+        cid = add_vps(bot, node)
+        # A user's restart holds the lock while the admin's bulk suspend starts
+        async with bot.lifecycle.lock(cid):
+            bulk = asyncio.create_task(bot.suspend_vps_many([cid]))
+            await asyncio.sleep(0.05)
+            assert not bulk.done()
+        await bulk
+        assert bot.vps_db[cid]["suspended"]
+        assert bot.lifecycle.desired[cid] == "stopped"
+
+    asyncio.run(main())
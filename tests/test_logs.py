@@ -0,0 +1,40 @@
+import json
+import os
+import time
+
+def test_log_rotates_by_size_and_reads_across_files(bot, tmp_path):
+    sink = bot.JsonlLogSink(str(tmp_path / "vps_logs.jsonl"), max_bytes=200, backups=10)
+    for i in range(10):
+        sink.write([{"i": i, "action": "x" * 40}])
+    rotated = sink.rotated_files()
+    assert rotated and all(os.path.getsize(path) >= 200 for path in rotated)
+    assert [e["i"] for e in sink.read_recent(100)] == list(range(10))
+    assert [e["i"] for e in sink.read_recent(3)] == [7, 8, 9]
+
+def test_rotated_logs_are_pruned_by_count_and_age(bot, tmp_path):
+    sink = bot.JsonlLogSink(str(tmp_path / "vps_logs.jsonl"), max_bytes=1, backups=2, retention_days=30)
+    for i in range(4):
+        sink.write([{"i": i}])
+    assert len(sink.rotated_files()) == 2
+    assert [e["i"] for e in sink.read_recent(100)] == [2, 3]
+
+    old = time.time() - 31 * 86400
+    os.utime(sink.rotated_files()[-1], (old, old))
+    sink.prune()
+    assert [e["i"] for e in sink.read_recent(100)] == [3]
+
+def test_legacy_log_is_imported_once_as_the_oldest_file(bot, tmp_path):
+    legacy = tmp_path / "vps_logs.json"
+    legacy.write_text(json.dumps([
+        {"timestamp": "2020-01-01T00:00:00", "action": "old"},
+        {"timestamp": "2020-01-02T00:00:00", "action": "older"},
+    ]))
+    sink = bot.JsonlLogSink(str(tmp_path / "vps_logs.jsonl"), max_bytes=1, backups=10, retention_days=100000)
+    sink.write([{"action": "new"}])
+    sink.import_legacy(str(legacy))
+    sink.import_legacy(str(legacy))
+
+    assert not legacy.exists() and (tmp_path / "vps_logs.json.imported").exists()
+    assert [e["action"] for e in sink.read_recent(100)] == ["old", "older", "new"]
+    # Dated by its last entry, so age pruning treats it as the oldest file
+    assert os.path.getmtime(sink.rotated_files()[-1]) == bot.datetime(2020, 1, 2).timestamp()
@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+from conftest import add_vps
+
+def test_placement_prefers_least_loaded_node_and_skips_draining(bot, fake_nodes):
+    async def main():
+        a, b, c = fake_nodes("a", "b", "c", ncpu=4, mem_gb=16)
+        await bot.prepare_docker_host()
+        add_vps(bot, a, cpu=4, ram=8)
+        add_vps(bot, b, cpu=2, ram=4)
+
+        assert bot.admission.place(1, 1, 10)[0] is c
+        ok, err = await bot.set_node_draining("c")
+        assert ok and err is None
+        assert bot.admission.place(1, 1, 10)[0] is b
+        with open(bot.NODE_STATE_FILE) as f:
+            assert json.load(f)["c"] == {"draining": True}
+
+        # Unhealthy nodes are skipped like draining ones
+        b.backend.up = False
+        await bot.check_node(b)
+        assert bot.admission.place(1, 1, 10)[0] is a
+
+        a.backend.up = False
+        await bot.check_node(a)
+        node, reason = bot.admission.place(1, 1, 10)
+        assert node is None and reason
+
+    asyncio.run(main())
+
+def test_create_vps_records_node_and_routes_later_calls(bot, fake_nodes):
+    async def main():
+        a, b = fake_nodes("a", "b", ncpu=8, mem_gb=32)
+        await bot.prepare_docker_host()
+        await bot.set_node_draining("a")
+        rec = await bot.create_vps(42, 2, 2, 10, admission_timeout=0)
+        assert rec.get("error") is None
+        assert rec["node"] == "b" and rec["container_id"] in b.backend.containers
+        assert bot.node_for(rec["container_id"]) is b
+
+        assert await bot.docker_stop_container(rec["container_id"])
+        assert b.backend.containers[rec["container_id"]]["state"] == "exited"
+        assert not any(call[0] == "stop" for call in a.backend.calls)
+
+        # Too big for any node: rejected straight away instead of queued
+        rec = await bot.create_vps(42, 1000, 2, 10, admission_timeout=0)
+        assert "exceeds" in rec["error"]
+
+    asyncio.run(main())
+
+def test_draining_empties_the_warm_pool_while_deploys_claim_from_it(bot, fake_nodes):
+    async def main():
+        a, b = fake_nodes("a", "b")
+        await bot.prepare_docker_host()
+        for _ in range(3):
+            cid, http_port, err = await bot.docker_run_container(1, 1, bot.DEFAULT_DISK_GB, name_prefix="vps-pool", node=a)
+            bot.warm_pool.append((cid, http_port))
+        remove = a.backend.remove
+
+        async def slow_remove(cid):
+            await asyncio.sleep(0.05)
+            return await remove(cid)
+
+        a.backend.remove = slow_remove
+        drain = asyncio.create_task(bot.set_node_draining("a"))
+        await asyncio.sleep(0.01)
+        # A deploy already placed on a tries the pool while the drain is removing containers
+        assert await bot.claim_warm_container(1, 1, bot.DEFAULT_DISK_GB, a) is None
+        assert await drain == (True, None)
+        assert bot.warm_pool == [] and a.backend.containers == {}
+
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+
+class User:
+    """Cached user whose send() raises the queued errors first"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.attempts = []
+
+    async def send(self, embed=None):
+        self.attempts.append(asyncio.get_running_loop().time())
+        if self.errors:
+            raise self.errors.pop(0)
+
+def http_error(bot, status):
+    return bot.discord.HTTPException(SimpleNamespace(status=status, reason="x"), "boom")
+
+def test_dm_is_retried_with_backoff_until_sent(bot):
+    async def main():
+        bot.DM_INTERVAL = 0.01
+        bot.DM_BACKOFF = 0.05
+        user = bot.user_cache[1] = User(http_error(bot, 503), bot.discord.RateLimited(0.01))
+
+        assert await bot.DmDispatcher().deliver(1, None) == "sent"
+        gaps = [b - a for a, b in zip(user.attempts, user.attempts[1:])]
+        assert len(gaps) == 2 and gaps[0] >= 0.05 and gaps[1] >= 0.1
+
+        # Errors that won't go away aren't retried; retries are limited
+        user = bot.user_cache[2] = User(http_error(bot, 400))
+        assert (await bot.DmDispatcher().deliver(2, None)).startswith("failed:") and len(user.attempts) == 1
+        bot.DM_RETRIES = 1
+        user = bot.user_cache[3] = User(*[http_error(bot, 500)] * 3)
+        assert (await bot.DmDispatcher().deliver(3, None)).startswith("failed:") and len(user.attempts) == 2
+
+    asyncio.run(main())
+
+def test_closed_dms_are_reported_once_without_retrying(bot):
+    async def main():
+        bot.DM_INTERVAL = 0.01
+        closed = bot.user_cache[1] = User(bot.discord.Forbidden(SimpleNamespace(status=403, reason="x"), "closed"))
+        bot.user_cache[2] = User()
+        statuses = {}
+        dispatcher = bot.DmDispatcher()
+        for uid in (1, 2):
+            dispatcher.send(uid, None, on_status=lambda status, uid=uid: statuses.setdefault(uid, status))
+        for _ in range(100):
+            if len(statuses) == 2:
+                break
+            await asyncio.sleep(0.01)
+
+        assert statuses == {1: "dms_closed", 2: "sent"}
+        assert len(closed.attempts) == 1
+        for task in dispatcher.tasks:
+            task.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+import asyncio
+
+from conftest import add_vps
+
+def test_run_retries_port_and_name_conflicts(bot, fake_nodes):
+    async def main():
+        node, = fake_nodes("a")
+        node.http_ports = bot.SlotAllocator(3000, 3001)
+        bot.name_numbers = bot.SlotAllocator(1000, 1001)
+        # Started outside the bot, so neither its port nor its name is in the allocators
+        node.backend.containers["foreign"] = {"name": "vps-1000", "image": "x", "state": "running", "ram": 1, "cpu": 1, "disk": None, "ports": {80: 3000}}
+
+        cid, http_port, err = await bot.docker_run_container(1, 1, 10, node=node)
+        assert err is None
+        assert http_port == 3001
+        assert node.backend.containers[cid]["name"] == "vps-1001"
+
+    asyncio.run(main())
+
+def test_slots_are_reserved_from_records_and_released_on_forget(bot, fake_nodes):
+    async def main():
+        node, = fake_nodes("a")
+        node.http_ports = bot.SlotAllocator(3000, 3000)
+        bot.name_numbers = bot.SlotAllocator(1000, 1000)
+        bot.vps_db["c1"] = {"node": "a", "name": "vps-1000", "http_port": 3000}
+        bot.load_slots_from_vps_db()
+        assert node.http_ports.allocate() is None and bot.name_numbers.allocate() is None
+
+        await bot.forget_container("c1")
+        assert node.http_ports.allocate() == 3000 and bot.name_numbers.allocate() == 1000
+
+    asyncio.run(main())
+
+def sidecars(node):
+    return {c["name"]: c for c in node.backend.containers.values() if c["name"].startswith("vps-fwd-")}
+
+def test_container_without_ip_is_never_forwarded(bot, fake_nodes):
+    async def main():
+        node, = fake_nodes("a")
+        cid = add_vps(bot, node, additional_ports=[8080])
+        del node.backend.containers[cid]["ip"]
+
+        ok, err = await bot.add_port_to_container(cid, 8080)
+        assert not ok and "running" in err
+        ok, err = await bot.port_forwarder.open(20000, cid, 8080)
+        assert not ok and "no IP" in err
+        assert not any(call[0] == "run_sidecar" for call in node.backend.calls)
+
+    asyncio.run(main())
+
+def test_forwards_close_on_suspend_and_follow_the_new_ip_on_start(bot, fake_nodes):
+    async def main():
+        bot.FORWARD_BIND_GRACE = 0
+        node, = fake_nodes("a")
+        cid = add_vps(bot, node, additional_ports=[8080])
+        suspended = add_vps(bot, node, state="exited", suspended=True, additional_ports=[22], port_map={"22": 20500})
+        await bot.restore_port_forwards()
+
+        host_port = bot.vps_db[cid]["port_map"]["8080"]
+        ip = node.backend.containers[cid]["ip"]
+        assert sidecars(node)[f"vps-fwd-{host_port}"]["cmd"][1] == f"TCP:{ip}:8080"
+        assert len(sidecars(node)) == 1 and "22" in bot.vps_db[suspended]["port_map"]
+
+        await bot.suspend_vps_many([cid])
+        assert sidecars(node) == {}
+        await bot.unsuspend_vps_many([cid])
+        new_ip = node.backend.containers[cid]["ip"]
+        assert new_ip != ip
+        assert sidecars(node)[f"vps-fwd-{host_port}"]["cmd"][1] == f"TCP:{new_ip}:8080"
+
+        await bot.delete_vps_many([cid])
+        assert sidecars(node) == {}
+
+    asyncio.run(main())
+
+def test_forward_retries_a_port_taken_on_the_node(bot, fake_nodes):
+    async def main():
+        bot.FORWARD_BIND_GRACE = 0
+        bot.forward_ports = bot.SlotAllocator(20000, 20001)
+        node, = fake_nodes("a")
+        # Started outside the bot, so its port isn't in the allocator
+        node.backend.containers["foreign"] = {"name": "web", "image": "x", "state": "running", "ram": 1, "cpu": 1, "disk": None, "ports": {80: 20000}}
+        cid = add_vps(bot, node)
+
+        ok, msg = await bot.add_port_to_container(cid, 8080)
+        assert ok and msg.endswith(":20001")
+        assert list(sidecars(node)) == ["vps-fwd-20001"]
+        assert bot.vps_db[cid]["port_map"] == {"8080": 20001}
+
+    asyncio.run(main())
+
+def test_forward_is_closed_when_its_record_cannot_be_saved(bot, fake_nodes):
+    async def main():
+        bot.FORWARD_BIND_GRACE = 0
+        node, = fake_nodes("a")
+        cid = add_vps(bot, node)
+
+        def persist_vps(*cids):
+            raise OSError("disk full")
+
+        bot.persist_vps = persist_vps
+        ok, err = await bot.add_port_to_container(cid, 8080)
+        assert not ok and err == "disk full"
+        assert sidecars(node) == {} and bot.vps_db[cid]["port_map"] == {}
+
+    asyncio.run(main())
@@ -0,0 +1,48 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from conftest import add_vps
+
+def test_rescheduled_deadline_fires_once_at_new_time(bot):
+    async def main():
+        fired = []
+
+        async def handler(key):
+            fired.append((key, datetime.utcnow()))
+
+        scheduler = bot.DeadlineScheduler(4)
+        scheduler.register("job", handler)
+        scheduler.start()
+        now = datetime.utcnow()
+        scheduler.schedule("job", "x", now + timedelta(seconds=0.1))
+        scheduler.schedule("job", "x", now + timedelta(seconds=0.3))
+        await asyncio.sleep(0.2)
+        assert fired == []
+        await asyncio.sleep(0.3)
+        assert [key for key, _ in fired] == ["x"]
+        assert fired[0][1] >= now + timedelta(seconds=0.3)
+        scheduler.task.cancel()
+
+    asyncio.run(main())
+
+def test_renew_moves_expiry_and_due_vps_is_suspended(bot, fake_nodes):
+    async def main():
+        node, = fake_nodes("a")
+        renewed = add_vps(bot, node, expires_in=timedelta(seconds=0.2))
+        expiring = add_vps(bot, node, expires_in=timedelta(seconds=0.2))
+        bot.start_deadline_scheduler()
+
+        # Renewing is a persist of the new expires_at
+        new_expiry = datetime.utcnow() + timedelta(days=15)
+        bot.vps_db[renewed]["expires_at"] = new_expiry.isoformat()
+        bot.persist_vps(renewed)
+        assert bot.deadline_scheduler.deadlines[("vps", renewed)] == new_expiry
+
+        await asyncio.sleep(0.5)
+        assert bot.vps_db[expiring]["suspended"] and not bot.vps_db[expiring]["active"]
+        assert node.backend.containers[expiring]["state"] == "exited"
+        assert not bot.vps_db[renewed]["suspended"]
+        assert node.backend.containers[renewed]["state"] == "running"
+        bot.deadline_scheduler.task.cancel()
+
+    asyncio.run(main())
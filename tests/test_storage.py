@@ -0,0 +1,68 @@
+import json
+import os
+
+def test_wal_replays_after_crash_and_skips_torn_record(bot, tmp_path):
+    path = str(tmp_path / "vps.json")
+    store = bot.WalStore(path)
+    data = {"a": {"n": 1}, "b": {"n": 2}}
+    store.commit(data, ["a", "b"])
+    data["a"]["n"] = 3
+    del data["b"]
+    store.commit(data, ["a", "b"])
+    # A crash mid-write leaves half a record at the end of the log
+    store.wal.write('{"k":"c","v":{"n"')
+    store.wal.flush()
+
+    reopened = bot.WalStore(path)
+    assert reopened.load() == {"a": {"n": 3}}
+
+    # The next record goes on its own line instead of being glued to the torn one
+    reopened.commit({"a": {"n": 3}, "d": {"n": 4}}, ["d"])
+    assert bot.WalStore(path).load() == {"a": {"n": 3}, "d": {"n": 4}}
+
+def test_wal_compaction_folds_log_into_snapshot(bot, tmp_path):
+    bot.WAL_COMPACT_EVERY = 3
+    path = str(tmp_path / "users.json")
+    store = bot.WalStore(path)
+    data = {}
+    for i in range(3):
+        data[str(i)] = {"points": i}
+        store.commit(data, [str(i)])
+    assert not os.path.exists(store.wal_path) and not os.path.exists(store.old_wal_path)
+    with open(path) as f:
+        assert json.load(f) == data
+    assert bot.WalStore(path).load() == data
+
+def test_wal_replays_log_left_by_interrupted_compaction(bot, tmp_path):
+    path = str(tmp_path / "vps.json")
+    with open(path, "w") as f:
+        json.dump({"a": 1}, f)
+    with open(path + ".wal.1", "w") as f:
+        f.write('{"k":"a","v":2}\n{"k":"b","v":1}\n')
+    with open(path + ".wal", "w") as f:
+        f.write('{"k":"a","v":3}\n{"k":"b"}\n')
+    assert bot.WalStore(path).load() == {"a": 3}
+
+def test_sqlite_migration_and_indexes(bot, tmp_path):
+    with open(bot.VPS_FILE, "w") as f:
+        json.dump({
+            "c1": {"owner": "1", "shared_with": ["2"], "expires_at": "2030-01-02T00:00:00", "active": True},
+            "c2": {"owner": "2", "shared_with": [], "expires_at": "2030-01-01T00:00:00", "active": True},
+        }, f)
+    # Pending log records are migrated too
+    with open(bot.VPS_FILE + ".wal", "w") as f:
+        f.write('{"k":"c3","v":{"owner":"3","shared_with":[],"expires_at":"2029-01-01T00:00:00","active":false}}\n')
+    conn = bot.open_sqlite(str(tmp_path / "bot.db"))
+    vps = bot.SqliteVpsStore(conn, "vps")
+    bot.migrate_json_to_sqlite(conn, [(bot.VPS_FILE, vps)])
+
+    assert set(vps.load()) == {"c1", "c2", "c3"}
+    assert sorted(vps.cids_for_user("2")) == ["c1", "c2"]
+    assert vps.cids_by_expiry() == ["c2", "c1"]
+
+    # Runs once: later JSON changes don't overwrite what SQLite now owns
+    data = vps.load()
+    data["c1"]["shared_with"] = []
+    vps.commit(data, ["c1"])
+    bot.migrate_json_to_sqlite(conn, [(bot.VPS_FILE, vps)])
+    assert vps.cids_for_user("2") == ["c2"]
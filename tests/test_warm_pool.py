@@ -0,0 +1,62 @@
+import asyncio
+
+async def pool_container(bot, node):
+    cid, http_port, err = await bot.docker_run_container(1, 1, bot.DEFAULT_DISK_GB, name_prefix="vps-pool", node=node)
+    assert err is None
+    bot.warm_pool.append((cid, http_port))
+    return cid, http_port
+
+def test_claim_takes_a_pool_container_on_the_node_and_applies_limits(bot, fake_nodes):
+    async def main():
+        a, b = fake_nodes("a", "b")
+        await bot.prepare_docker_host()
+        other = await pool_container(bot, b)
+        entry = await pool_container(bot, a)
+        number = bot.container_slots[entry[0]]["name"]
+
+        assert await bot.claim_warm_container(4, 2, bot.DEFAULT_DISK_GB, a) == entry
+        c = a.backend.containers[entry[0]]
+        assert c["name"] == f"vps-{number}" and (c["ram"], c["cpu"]) == (4, 2)
+        assert bot.warm_pool == [other]
+        assert bot.get_warm_pool_stats()["hits"] == 1
+
+    asyncio.run(main())
+
+def test_claim_misses_on_an_empty_pool_or_a_custom_disk_size(bot, fake_nodes):
+    async def main():
+        node, = fake_nodes("a")
+        await bot.prepare_docker_host()
+        assert await bot.claim_warm_container(1, 1, bot.DEFAULT_DISK_GB, node) is None
+        # The quota of a pool container can't be changed, so it only fits the default disk
+        entry = await pool_container(bot, node)
+        assert await bot.claim_warm_container(1, 1, bot.DEFAULT_DISK_GB + 10, node) is None
+        assert bot.warm_pool == [entry]
+        assert bot.get_warm_pool_stats()["misses"] == 2
+
+    asyncio.run(main())
+
+def test_pool_container_that_cannot_be_claimed_is_removed(bot, fake_nodes):
+    async def main():
+        node, = fake_nodes("a")
+        await bot.prepare_docker_host()
+        broken = await pool_container(bot, node)
+        number = bot.container_slots[broken[0]]["name"]
+        # Its final name is taken, so the rename fails
+        node.backend.containers["foreign"] = {"name": f"vps-{number}", "image": "x", "state": "running", "ram": 1, "cpu": 1, "disk": None, "ports": {}}
+
+        assert await bot.claim_warm_container(1, 1, bot.DEFAULT_DISK_GB, node) is None
+        assert broken[0] not in node.backend.containers and broken[0] not in bot.container_slots
+        assert bot.warm_pool == [] and bot.get_warm_pool_stats()["misses"] == 1
+
+        # A failed limit update is the same, and the next pool container is tried
+        failing, good = await pool_container(bot, node), await pool_container(bot, node)
+        update = node.backend.update
+
+        async def update_once_failing(cid, ram_gb, cpu):
+            return cid != failing[0] and await update(cid, ram_gb, cpu)
+
+        node.backend.update = update_once_failing
+        assert await bot.claim_warm_container(1, 1, bot.DEFAULT_DISK_GB, node) == good
+        assert failing[0] not in node.backend.containers
+
+    asyncio.run(main())